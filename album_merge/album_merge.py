@@ -2,8 +2,13 @@
 
 import os
 import sys
+import argparse
 import subprocess
 import shutil
+import tempfile
+import hashlib
+import concurrent.futures
+import importlib.util
 
 import unit
 import uid
@@ -11,6 +16,24 @@ import markup
 import flac
 import mp3
 import util
+import cache
+import stitch
+import pcm
+import mka
+import runner
+import imageinfo
+
+# Shared with the scripts at the top of the repository, and loaded from there
+# by path so that nothing else in that directory becomes importable.
+def load_shared_module(name):
+    path = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), name + '.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+imagederive = load_shared_module('imagederive')
 
 class ImageMeta(object):
     def __init__(self, format, width, height):
@@ -29,34 +52,57 @@ class ImageMeta(object):
 
     # NOTE: requires imagemagick
     @staticmethod
-    def __identify(filename, stdin = subprocess.DEVNULL):
-        return subprocess.Popen(
-                ['identify', '-format', '%W %H %m', filename],
-                stdout=subprocess.PIPE, stdin=stdin,
-                stderr=subprocess.DEVNULL)
-
-    @staticmethod
-    def __process_output(child):
-        result = next(util.line_reader(child.stdout))  # one line
-        child.stdout.close()
-        if child.wait() != 0:
+    def __identify(filename, data = None):
+        child = runner.run(['identify', '-format', '%W %H %m', filename],
+                input=data, capture=True, quiet=True,
+                timeout=runner.PROBE_TIMEOUT, check=False)
+        if child.returncode != 0:
             raise RuntimeError('Could not identify image properties.')
-        parts = result.split(' ', 2)
+        result = child.stdout.decode(sys.getdefaultencoding())
+        parts = result.splitlines()[0].split(' ', 2)
         return ImageMeta(format = parts[2].lower(),
                 width = int(parts[0]), height = int(parts[1]))
 
+    # The headers of the common formats are read natively; identify is left
+    # for anything else.
+    @staticmethod
+    def __from_probe(result):
+        if result is None:
+            return None
+        return ImageMeta(format = result[0],
+                width = result[1], height = result[2])
+
     @staticmethod
     def from_file(filename):
-        child = ImageMeta.__identify(filename)
-        return ImageMeta.__process_output(child)
+        meta = ImageMeta.__from_probe(imageinfo.probe_file(filename))
+        if meta is not None:
+            return meta
+        return ImageMeta.__identify(filename)
 
     @staticmethod
     def from_data(data):
-        child = ImageMeta.__identify('-', subprocess.PIPE)
-        child.stdin.write(data)
-        child.stdin.close()
-        return ImageMeta.__process_output(child)
-
+        meta = ImageMeta.__from_probe(imageinfo.probe_data(data))
+        if meta is not None:
+            return meta
+        return ImageMeta.__identify('-', data)
+
+    # From a FileRange or BufferRange, reading only its header unless
+    # identify is needed.  Memoized by picture digest, as the same cover is
+    # usually embedded in every track.
+    @staticmethod
+    def from_range(digest, data):
+        meta = _range_meta.get(digest)
+        if meta is None:
+            meta = ImageMeta.__from_probe(imageinfo.probe(data.read_at))
+            if meta is None:
+                meta = ImageMeta.from_data(data.read())
+            _range_meta[digest] = meta
+        return meta
+
+_range_meta = {}
+
+# data is any bytes-like object, including the read-only view from
+# util.load_file; it is never copied or modified.
 class Image(object):
     def __init__(self, data):
         self.set_data(data)
@@ -75,11 +121,7 @@ class Image(object):
 
     @staticmethod
     def from_file(filename):
-        data = bytearray()
-        with open(filename, 'rb') as handle:
-            for block in util.block_reader(handle):
-                data += block
-        return Image(data)
+        return Image(util.load_file(filename))
 
 
 # image has changed, need to update things
@@ -95,30 +137,184 @@ AUDIO_FLAC = 1
 AUDIO_MP3 = 2
 AUDIO_ERROR = 3
 
-def scanDirectory(dirname, db):
+AUDIO_EXTENSIONS = { '.flac': AUDIO_FLAC, '.mp3': AUDIO_MP3 }
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+# Audio probes collect their pictures separately, so the probe cache can
+# store them along with the meta.
+def probe_audio(meta_type, filename, want_pictures):
+    digest_map = {} if want_pictures else None
+    return (meta_type.from_file(filename, digest_map), digest_map)
+
+# Only references to picture data are cached, never the data: a picture the
+# metaflac fallback read into memory is located in the file instead, or
+# cached as None if it can't be.
+def cacheable_range(filename, data):
+    if isinstance(data, util.BufferRange):
+        return util.locate_range(filename, data.data)
+    return data
+
+def probe_file(filename, db):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in AUDIO_EXTENSIONS:
+        meta_type = flac.FLACMeta if ext == '.flac' else mp3.MP3Meta
+        kind = ext[1:] + ('_pictures' if db is not None else '')
+        probed = {}  # this run's own pictures, if it wasn't a hit
+        def probe():
+            meta, digest_map = probe_audio(meta_type, filename,
+                    db is not None)
+            if digest_map:
+                probed.update(digest_map)
+                digest_map = {digest: cacheable_range(filename, data)
+                        for digest, data in digest_map.items()}
+            return (meta, digest_map)
+        meta, digest_map = cache.cached(kind, filename, probe)
+        if probed:
+            digest_map = probed
+        elif digest_map and None in digest_map.values():
+            # the picture data wasn't cached, so has to be read again
+            meta, digest_map = probe_audio(meta_type, filename, True)
+        if digest_map:
+            for digest, data in digest_map.items():
+                if isinstance(data, util.FileRange):
+                    # may have been cached under another relative path
+                    data.filename = filename
+                db.setdefault(digest, data)
+        return FileMeta(filename, meta)
+    # plain values, as ImageMeta may be pickled as __main__.ImageMeta
+    image = cache.cached('image', filename, lambda: vars(
+            ImageMeta.from_file(filename)))
+    return FileMeta(filename, ImageMeta(**image))
+
+# Probes run in a thread pool; they're spent waiting on external tools or
+# file reads, and the results are collected back in file name order.
+def scanDirectory(dirname, db, jobs = 1):
     files = os.listdir(dirname)
     files.sort()  # relying on file names to be sorted
-    tracks = []
-    images = []
+    track_names = []
+    image_names = []
     audio_type = 0
     for basename in files:
         filename = os.path.join(dirname, basename)
         ext = os.path.splitext(basename)[1].lower()
-        if ext == '.flac':
-            tracks.append(FileMeta(filename,
-                    flac.FLACMeta.from_file(filename, db)))
-            audio_type = audio_type | AUDIO_FLAC
-        if ext == '.mp3':
-            tracks.append(FileMeta(filename,
-                    mp3.MP3Meta.from_file(filename, db)))
-            audio_type = audio_type | AUDIO_MP3
-        if ext in ['.jpg', '.jpeg', '.png']:
-            images.append(FileMeta(filename,
-                    ImageMeta.from_file(filename)))
+        if ext in AUDIO_EXTENSIONS:
+            track_names.append(filename)
+            audio_type = audio_type | AUDIO_EXTENSIONS[ext]
+        if ext in IMAGE_EXTENSIONS:
+            image_names.append(filename)
         if audio_type == AUDIO_ERROR:
             raise RuntimeError("ERROR: Mixing flac and mp3 input files!")
 
-    return (audio_type, tracks, images)
+    # the first failure stops any probes that haven't started
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        futures = [executor.submit(probe_file, filename, db)
+                for filename in track_names + image_names]
+        done, not_done = concurrent.futures.wait(futures,
+                return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        results = [future.result() for future in futures]
+    cache.flush()  # the hits' access times, in one commit
+
+    return (audio_type, results[:len(track_names)],
+            results[len(track_names):])
+
+# The sox command converting the track to the given format in dest_dir, and
+# the file it writes.
+def resample_command(track, dest_dir, sample_rate, channels):
+    print('Resampling track from {}:{} to {}:{}: {}'.format(
+            track.meta.sample_rate, track.meta.channels,
+            sample_rate, channels, os.path.basename(track.filename)))
+    newfile = os.path.join(dest_dir, os.path.basename(track.filename))
+    # req sox
+    return (['sox', track.filename, newfile,
+            'channels', str(channels), 'rate', str(sample_rate)], newfile)
+
+# Updates the track to refer to its converted file, but keeping its original
+# comments/pictures.
+def resampled_track(track, newfile):
+    newtrack = flac.FLACMeta.from_file(newfile)
+    track.filename = newfile
+    track.meta.sample_rate = newtrack.sample_rate
+    track.meta.channels = newtrack.channels
+    track.meta.bits_per_sample = newtrack.bits_per_sample
+    track.meta.total_samples = newtrack.total_samples
+
+# Resamples every track that doesn't match the format, as many at a time as
+# the runner allows sox.  The first failure kills the other conversions and
+# is raised.  Returns True if any track was resampled.
+def resample_tracks(tracks, dest_dir, sample_rate, channels):
+    pending = [track for track in tracks
+            if (track.meta.sample_rate, track.meta.channels) !=
+                    (sample_rate, channels)]
+    if not pending:
+        return False
+    commands = [resample_command(track, dest_dir, sample_rate, channels)
+            for track in pending]
+    try:
+        runner.run_all([command for command, newfile in commands])
+    except runner.ToolError as error:
+        # named by the track whose conversion failed first
+        track = pending[[command for command, newfile in commands].index(
+                error.command)]
+        raise RuntimeError('Error resampling {} ({})'.format(
+                track.filename, error))
+    for track, (command, newfile) in zip(pending, commands):
+        resampled_track(track, newfile)
+    return True
+
+# The length of the track once converted to sample_rate.  sox's rate effect
+# keeps the duration, so this is exact to within a sample.
+def converted_samples(meta, sample_rate):
+    if meta.sample_rate == sample_rate:
+        return meta.total_samples
+    return round(meta.total_samples * sample_rate / meta.sample_rate)
+
+FLAC_OPTIONS = ['--force', '--no-preserve-modtime', '--best']
+
+# Encodes a track to a FLAC segment of the merged stream, converting it to
+# the given format if needed.
+def encode_segment(filename, output, bits_per_sample = None,
+        sample_rate = None, channels = None):
+    bits = ['-b', str(bits_per_sample)] if bits_per_sample else []
+    effects = []
+    if channels is not None:
+        effects.extend(['channels', str(channels)])
+    if sample_rate is not None:
+        effects.extend(['rate', str(sample_rate)])
+    # req sox
+    sox = subprocess.Popen(['sox', filename] + bits + ['-t', 'wav', '-'] +
+            effects, stdout=subprocess.PIPE,
+            stdin=subprocess.DEVNULL)  # print errors to terminal
+    # req flac
+    flac_encoder = subprocess.Popen(
+            ['flac', '--silent'] + FLAC_OPTIONS + ['-o', output, '-'],
+            stdin=sox.stdout)
+    sox.stdout.close()  # only the encoder reads it
+    flac_ret = flac_encoder.wait()
+    sox_ret = sox.wait()
+    if flac_ret != 0 or sox_ret != 0:
+        raise RuntimeError('Error encoding ' + filename)
+    return output
+
+# Encodes each track as its own segment, several at once, then joins the
+# segments' frames into one stream (see stitch).
+def encode_parallel(filenames, output, work_dir, seekpoints, bits_per_sample,
+        jobs, sample_rate = None, channels = None):
+    with tempfile.TemporaryDirectory(prefix='segments_',
+            dir=work_dir) as segment_dir:
+        segments = [os.path.join(segment_dir, '{:04d}.flac'.format(i))
+                for i in range(len(filenames))]
+        with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+            futures = [executor.submit(encode_segment, filename, segment,
+                    bits_per_sample, sample_rate, channels)
+                    for filename, segment in zip(filenames, segments)]
+            for future in futures:
+                future.result()
+        stitch.merge_files(segments, output, seekpoints)
 
 #cover.jpg              - 600 x [>=600] (portrait/square) first attachment
 #small_cover.jpg        - 120 x [>=120] (portrait/square)
@@ -128,8 +324,33 @@ def scanDirectory(dirname, db):
 COVER_OPTIONS = [
         [('cover', '', 600), ('small_cover', '', 120)],  # portrait
         [('cover', 600, ''), ('small_cover', 120, '')]]  # landscape
+
+# Everything prepare produces aside from the merged audio, and what is needed
+# to merge it.
+class PreparedAlbum(object):
+    def __init__(self, audio_type, tracks, seekpoints, sample_rate, channels,
+            resampled):
+        self.audio_type = audio_type
+        self.tracks = tracks
+        self.seekpoints = seekpoints
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.resampled = resampled
+
+    def merged_name(self):
+        return 'merged.flac' if self.audio_type == AUDIO_FLAC else 'merged.mp3'
+
 def prepare_flac_album(source_dir, dest_dir, sample_rate = None,
-        channels = None):
+        channels = None, jobs = 1, reencode = False, inline_resample = False):
+    album = prepare_album(source_dir, dest_dir, sample_rate, channels, jobs,
+            inline_resample)
+    return merge_audio(album, os.path.join(dest_dir, album.merged_name()),
+            dest_dir, jobs, reencode)
+
+# Writes the chapters, tags and pictures (and any resampled/stripped tracks)
+# to dest_dir, without merging the audio.
+def prepare_album(source_dir, dest_dir, sample_rate = None, channels = None,
+        jobs = 1, inline_resample = False):
     picture_db = {}
     uid_group = uid.Group()
 
@@ -138,9 +359,10 @@ def prepare_flac_album(source_dir, dest_dir, sample_rate = None,
     picture_xml = markup.PictureFile()
 
 
-    audio_type, tracks, images = scanDirectory(source_dir, picture_db)
+    audio_type, tracks, images = scanDirectory(source_dir, picture_db, jobs)
 
     image_names = set()
+    cover_requests = []  # (dest names, request) for imagederive
     for image in images:
         name = os.path.splitext(os.path.basename(image.filename))[0]
         suffix = '_land' if image.meta.landscape() else ''
@@ -148,20 +370,28 @@ def prepare_flac_album(source_dir, dest_dir, sample_rate = None,
         if name.lower() == 'cover' + suffix:
             name = 'full_cover' + suffix
         if name.lower() in ['full_cover', 'full_cover_land']:
-            for gen_name, width, height in COVER_OPTIONS[image.meta.landscape()]:
-                dest_name = gen_name + suffix + ext
-                # req imagemagick
-                convert = subprocess.Popen(['convert', image.filename,
-                        '-adaptive-resize', '{}x{}'.format(width, height),
-                        os.path.join(dest_dir, dest_name)])
-                if convert.wait() != 0:
-                    raise RuntimeError('Error generating image:'
-                            ' {}'.format(dest_name))
-                image_names.add(dest_name)
+            options = COVER_OPTIONS[image.meta.landscape()]
+            cover_requests.append((
+                    [gen_name + suffix + ext for gen_name, width, height
+                            in options],
+                    (image.filename, [imagederive.Derivative(
+                            '{}x{}'.format(width, height), 'adaptive-resize')
+                            for gen_name, width, height in options], ext)))
         dest_name = name + ext
         shutil.copy(image.filename, os.path.join(dest_dir, dest_name))
         image_names.add(dest_name)
 
+    # every size of a cover comes from one decode of it, and is cached
+    try:
+        derived = imagederive.derive_all([request for dest_names, request in
+                cover_requests], jobs)
+    except (RuntimeError, OSError) as error:
+        raise RuntimeError('Error generating cover images: {}'.format(error))
+    for (dest_names, request), outputs in zip(cover_requests, derived):
+        for dest_name, output in zip(dest_names, outputs):
+            shutil.copy(output, os.path.join(dest_dir, dest_name))
+            image_names.add(dest_name)
+
     for name in sorted(list(image_names)):
         picture_xml.pictures().append(markup.Picture(name, name))
 
@@ -210,7 +440,16 @@ def prepare_flac_album(source_dir, dest_dir, sample_rate = None,
         channels = max([track.meta.channels for track in tracks])
         print('Highest channels: {}'.format(channels))
 
-    bit_rate = None
+    bit_rates = set()  # of the MP3 tracks, None for each VBR one
+    resampled = False
+    if audio_type == AUDIO_FLAC:
+        if inline_resample:
+            # converted while merging instead, by the decoders
+            resampled = any((track.meta.sample_rate, track.meta.channels) !=
+                    (sample_rate, channels) for track in tracks)
+        else:
+            resampled = resample_tracks(tracks, dest_dir, sample_rate,
+                    channels)
 
     for track in tracks:
         if (audio_type == AUDIO_MP3):
@@ -218,39 +457,16 @@ def prepare_flac_album(source_dir, dest_dir, sample_rate = None,
                     channels != track.meta.channels):
                 raise RuntimeError('Inconsistent sample rate/channels/bit rate!')
             newfile = os.path.join(dest_dir, os.path.basename(track.filename))
-            if (not mp3.strip_all_metadata(track.filename, newfile)):
+            stripped = mp3.strip_all_metadata(track.filename, newfile)
+            if stripped is None:
                 raise RuntimeError('Failed to strip metadata from: {}'.format(
                     track.filename))
             track.filename = newfile
-            # have to recalculate
-            stripped_bit_rate = util.sox_info(newfile)['Bit Rate']
-            if bit_rate is None:
-                bit_rate = stripped_bit_rate
-            elif bit_rate != stripped_bit_rate:
-                raise RuntimeError('Inconsistent bit rate!')
-
-
-        if (audio_type == AUDIO_FLAC and
-                sample_rate != track.meta.sample_rate or
-                channels != track.meta.channels):
-            print('Resampling track from {}:{} to {}:{}'.format(
-                    track.meta.sample_rate, track.meta.channels,
-                    sample_rate, channels))
-            newfile = os.path.join(dest_dir, os.path.basename(track.filename))
-            # Resample
-            sox = subprocess.Popen(['sox', track.filename, newfile,
-                    'channels', str(channels), 'rate', str(sample_rate)],
-                    stdout=subprocess.DEVNULL,
-                    stdin=subprocess.DEVNULL)  # print errors to terminal
-            if sox.wait() != 0:
-                raise RuntimeError('Error upsampling ' + track.filename)
-            # Read new file
-            newtrack = flac.FLACMeta.from_file(newfile)
-            # update to refer to resampled file instead, but keeping original
-            # comments/pictures
-            track.filename = newfile
-            track.meta.sample_rate = newtrack.sample_rate
-            track.meta.total_samples = newtrack.total_samples
+            # the info frame is gone, so count exactly what was kept
+            track.meta.total_samples = stripped.total_samples
+            # known from the frames that were kept; None if variable
+            bit_rates.add(stripped.bit_rate())
+
 
         # Seek points
         seekpoints.append(sample_offset)  # start of track
@@ -259,7 +475,7 @@ def prepare_flac_album(source_dir, dest_dir, sample_rate = None,
         chapter = markup.Chapter(
                 uid=str(uid_group.generate()),
                 start_time=sample_offset * unit.SEC / sample_rate)
-        sample_offset += track.meta.total_samples
+        sample_offset += converted_samples(track.meta, sample_rate)
         chapter.add_comment(track.filename)
         chapter_xml.chapters().append(chapter)
 
@@ -326,6 +542,12 @@ def prepare_flac_album(source_dir, dest_dir, sample_rate = None,
                     our_list.append(picture)
             pictures[picture_type] = our_list
 
+    # Concatenation only needs the sample rates and channels to match, but an
+    # album that is all constant bit rate shouldn't mix rates.  With any VBR
+    # track there's no constant rate to keep, so any mix is fine.
+    if None not in bit_rates and len(bit_rates) > 1:
+        raise RuntimeError('Inconsistent bit rate!')
+
     with open(os.path.join(dest_dir, 'chapters.xml'), 'wb') as handle:
         chapter_xml.write(handle)
     with open(os.path.join(dest_dir, 'tags.xml'), 'wb') as handle:
@@ -334,157 +556,414 @@ def prepare_flac_album(source_dir, dest_dir, sample_rate = None,
     for picture_type, picture_list  in pictures.items():
         i = 0
         for picture in picture_list:
+            # a reference into the source track; this is the only point the
+            # picture bytes are actually copied.
             data = picture_db.get(picture.digest)
-            meta = ImageMeta.from_data(data)
-            basename = ('flacgen_' + picture_type.name.lower() +
-                    '_' + str(i) + meta.extension())
+            basename = 'flacgen_' + picture_type.name.lower() + '_' + str(i)
             i += 1
-            util.write_file(os.path.join(dest_dir, basename), data)
+            meta = ImageMeta.from_range(picture.digest, data)
+            basename += meta.extension()
+            data.write_to(os.path.join(dest_dir, basename))
 
             picture_xml.pictures().append(markup.Picture(
                 basename, basename, picture.description))
     with open(os.path.join(dest_dir, 'pictures.xml'), 'wb') as handle:
         picture_xml.write(handle)
 
-    if audio_type == AUDIO_FLAC:
-        # req sox
-        sox = subprocess.Popen(['sox'] + [track.filename for track in tracks] +
-                ['-t', 'wav', '-'], stdout=subprocess.PIPE,
-                stdin=subprocess.DEVNULL)  # print errors to terminal
-
-        flac_options = ['--force', '--no-preserve-modtime', '--best']
-        flac_seekpoints = ['--seekpoint={}'.format(sample)
-                        for sample in seekpoints]
-        output = os.path.join(dest_dir, 'merged.flac')
-        # req flac
-        flac_encoder = subprocess.Popen(
-                ['flac'] + flac_options + flac_seekpoints + ['-o', output, '-'],
-                stdin=sox.stdout)  # print status to terminal
+    return PreparedAlbum(audio_type, tracks, seekpoints, sample_rate,
+            channels, resampled)
+
+# Merges the prepared tracks into output, which is either a filename or a
+# handle to stream to (such as a pipe to a muxer).  Any temporary files go
+# in work_dir, though none are written when streaming: a re-encode is then
+# always serial, straight from the decoders' pipes to the encoder's, since
+# the parallel one spools its segments to disk.  A streamed FLAC has to
+# start with its STREAMINFO, before the audio it describes has been seen, so
+# it has no MD5 (all zeros, meaning unknown) and no SEEKTABLE.
+def merge_audio(album, output, work_dir, jobs = 1, reencode = False):
+    tracks = album.tracks
+    seekpoints = album.seekpoints
+    sample_rate = album.sample_rate
+    channels = album.channels
+    streaming = not isinstance(output, str)
+
+    if album.audio_type == AUDIO_FLAC:
+        if (not reencode and not album.resampled and
+                stitch.can_stitch([track.meta for track in tracks])):
+            # same format throughout; the existing frames can just be joined
+            print('Merging FLAC frames without re-encoding.')
+            # when streaming, the tracks are all checked before any frames
+            # are written, so output is still empty if this fails
+            try:
+                stitch.merge_files([track.filename for track in tracks],
+                        output, seekpoints)
+                return 0
+            except ValueError as error:
+                print('Frame merge failed ({}), re-encoding.'.format(error),
+                        file=sys.stderr)
+
+        stopwatch = util.Stopwatch()
+        if jobs > 1 and len(tracks) > 1 and not streaming:
+            print('Encoding {} segments, {} at a time.'.format(
+                    len(tracks), jobs))
+            bits = [track.meta.bits_per_sample for track in tracks]
+            try:
+                encode_parallel([track.filename for track in tracks], output,
+                        work_dir, seekpoints, None if None in bits else
+                        max(bits), jobs, sample_rate, channels)
+            except (RuntimeError, ValueError) as error:
+                print("ERROR: {}".format(error), file=sys.stderr)
+                return 1
+            print(stopwatch.summary('Parallel encode'))
+            return 0
+
+        # the seek table is written last, so needs a seekable output
+        flac_seekpoints = [] if streaming else ['--seekpoint={}'.format(
+                sample) for sample in seekpoints]
+        bits = [track.meta.bits_per_sample for track in tracks]
+        pcm_format = pcm.Format(sample_rate, channels,
+                16 if None in bits else max(bits))
+        flac_encoder = subprocess.Popen(pcm_format.encode_command(
+                FLAC_OPTIONS + flac_seekpoints, None if streaming else output),
+                stdin=subprocess.PIPE, stdout=output if streaming else None)
+                # print status to terminal
+
+        def progress(index, concatenator):
+            print('Decoded {}/{}: {}; {}; {}'.format(index + 1, len(tracks),
+                    os.path.basename(tracks[index].filename),
+                    concatenator.decoded.summary('decoded'),
+                    concatenator.encoded.summary('encoded')))
+
+        concatenator = pcm.Concatenator([track.filename for track in tracks],
+                pcm_format, flac_encoder, progress)
+        try:
+            concatenator.run()
+        except (RuntimeError, OSError) as error:
+            print("ERROR: {}".format(error), file=sys.stderr)
+            flac_encoder.wait()
+            return 1
         flac_ret = flac_encoder.wait()
-        sox_ret = sox.wait()
         if flac_ret != 0:
             print("ERROR: FLAC encoder exited with code {}".format(flac_ret),
                     file=sys.stderr)
-        if sox_ret != 0:
-            print("ERROR: SOX exited with code {}".format(sox_ret),
-                    file=sys.stderr)
-        return int(not (flac_ret == 0 and sox_ret == 0))  # 0 == success
-    elif audio_type == AUDIO_MP3:
-        output = os.path.join(dest_dir, 'merged.mp3')
-        cat_ret = 1
-        with open(output, 'wb') as outfile:
-            cat = subprocess.Popen(['cat'] +
-                    [track.filename for track in tracks],
-                    stdout=outfile,
-                    stdin=subprocess.DEVNULL)  # print errors to terminal
-            cat_ret = cat.wait()
-        if cat_ret != 0:
-            print("ERROR: CAT exited with code {}".format(cat_ret),
+        print(stopwatch.summary('Serial encode'))
+        return int(flac_ret != 0)  # 0 == success
+    elif album.audio_type == AUDIO_MP3:
+        def progress(index, filename, byte_offset):
+            print('Appending {}/{}: {} (byte {}, sample {})'.format(
+                    index + 1, len(tracks), os.path.basename(filename),
+                    byte_offset, seekpoints[index]))
+
+        try:
+            util.concatenate_files([track.filename for track in tracks],
+                    output, progress)
+        except (OSError, ValueError) as error:
+            print("ERROR: Failed to merge tracks: {}".format(error),
                     file=sys.stderr)
-        return int(not (cat_ret == 0))  # 0 == success
+            return 1
+        return 0  # 0 == success
     raise RuntimeError('Unsupported audio type!')
 
 
-def assemble_mkv(source_dir, dest_dir):
+def assemble_mkv(source_dir, dest_dir, native = True):
     input_file = os.path.join(source_dir, 'merged.flac')
     if not os.path.exists(input_file):
         input_file = os.path.join(source_dir, 'merged.mp3')
     output_file = os.path.join(dest_dir, 'output.mka')
+
+    if native:
+        chapter_xml = markup.ChapterFile(element = markup.loadXML(
+                os.path.join(source_dir, 'chapters.xml')))
+        tag_xml = markup.TagFile(element = markup.loadXML(
+                os.path.join(source_dir, 'tags.xml')))
+        picture_xml = markup.PictureFile(element = markup.loadXML(
+                os.path.join(source_dir, 'pictures.xml')))
+        try:
+            mka.write_file(output_file, input_file, chapter_xml, tag_xml,
+                    mka.picture_attachments(picture_xml, source_dir))
+            return 0
+        except ValueError as error:
+            print('Native Matroska writer failed ({}), using mkvmerge.'.format(
+                    error), file=sys.stderr)
+
     command = ['mkvmerge', '-o', output_file,
             '--chapters', os.path.join(source_dir, 'chapters.xml'),
             '--global-tags', os.path.join(source_dir, 'tags.xml'),
             '--language', '0:eng', '--default-track', '0:1',
             input_file]
 
+    for picture in load_pictures(source_dir):
+        if picture.description() is not None:
+            command.extend([
+                '--attachment-description', picture.description()])
+        command.extend([
+            '--attachment-name', picture.name(),
+            '--attach-file', os.path.join(source_dir, picture.filename())])
+    print(command)
+    child = subprocess.Popen(command)
+    return child.wait()
+
+def load_pictures(source_dir):
     picture_xml = markup.PictureFile(
             element = markup.loadXML(os.path.join(source_dir, 'pictures.xml')))
-
-    pictures = [markup.Picture(element=child) for child in
+    return [markup.Picture(element=child) for child in
             picture_xml.pictures().children()]
 
-    for picture in pictures:
+# prepare and assemble in one pass: the merged audio is streamed straight
+# into the muxer rather than written to dest_dir first.  mkvmerge can't read
+# from a pipe, so ffmpeg muxes the stream (copying it, not re-encoding), and
+# mkvpropedit then adds the chapters, tags and attachments in place.
+# Mismatched FLAC tracks are converted while merging, and any re-encode is
+# serial (see merge_audio), so no FLAC audio is written to disk; MP3 tracks
+# are still copied to dest_dir with their tags stripped.  The streamed FLAC
+# has no STREAMINFO MD5 or SEEKTABLE; players seek with the Cues ffmpeg
+# writes instead, and checksplit can verify the audio.
+# req ffmpeg, mkvpropedit
+def build_mkv(source_dir, dest_dir, sample_rate = None, channels = None,
+        jobs = 1, reencode = False):
+    album = prepare_album(source_dir, dest_dir, sample_rate, channels, jobs,
+            inline_resample=True)
+    output_file = os.path.join(dest_dir, 'output.mka')
+    input_format = 'flac' if album.audio_type == AUDIO_FLAC else 'mp3'
+    muxer = subprocess.Popen(['ffmpeg', '-nostdin', '-loglevel', 'error',
+            '-y', '-f', input_format, '-i', '-', '-map', '0:a', '-c', 'copy',
+            '-metadata:s:a:0', 'language=eng', '-disposition:a:0', 'default',
+            output_file], stdin=subprocess.PIPE)
+    try:
+        exit_code = merge_audio(album, muxer.stdin, dest_dir, jobs, reencode)
+    except OSError as error:  # such as the muxer exiting early
+        print("ERROR: Failed to stream audio: {}".format(error),
+                file=sys.stderr)
+        exit_code = 1
+    try:
+        muxer.stdin.close()
+    except OSError:
+        pass
+    mux_ret = muxer.wait()
+    if mux_ret != 0:
+        print("ERROR: ffmpeg exited with code {}".format(mux_ret),
+                file=sys.stderr)
+        return 1
+    if exit_code != 0:
+        return exit_code
+
+    command = ['mkvpropedit', output_file,
+            '--chapters', os.path.join(dest_dir, 'chapters.xml'),
+            '--tags', 'global:' + os.path.join(dest_dir, 'tags.xml')]
+    for picture in load_pictures(dest_dir):
         if picture.description() is not None:
             command.extend([
                 '--attachment-description', picture.description()])
         command.extend([
             '--attachment-name', picture.name(),
-            '--attach-file', os.path.join(source_dir, picture.filename())])
+            '--add-attachment', os.path.join(dest_dir, picture.filename())])
     print(command)
     child = subprocess.Popen(command)
     return child.wait()
 
-def check_split_accuracy(source_dir, split_dir):
-    tracks, images = scanDirectory(source_dir, None)
-    split_files = os.listdir(split_dir)
-    split_files.sort()
+UNKNOWN_MD5 = bytes(16)
+# for audio without a bit depth of its own (MP3)
+DEFAULT_DECODE_BITS = 16
+
+# The MD5 of the track's decoded audio as signed little-endian samples of
+# bits_per_sample, which is what FLAC stores in STREAMINFO; so for a FLAC
+# track of that depth it's read from there, rather than decoding it.
+# Returns (md5, how it was found).
+def audio_md5(track, bits_per_sample):
+    md5 = getattr(track.meta, 'md5', None)
+    if (md5 is not None and md5 != UNKNOWN_MD5 and
+            track.meta.bits_per_sample == bits_per_sample):
+        return (md5, 'streaminfo')
+    digest = hashlib.md5()
+    pcm_format = pcm.Format(track.meta.sample_rate, track.meta.channels,
+            bits_per_sample)
+    runner.run(pcm_format.decode_command(track.filename),
+            on_data=digest.update)
+    return (digest.digest(), 'decoded')
+
+# The outcome of comparing a source track with the file split from the
+# merged album that should match it.
+class SplitCheck(object):
+    def __init__(self, source, split_filename):
+        self.source = source
+        self.split_filename = split_filename
+        self.samples = None  # (source, split)
+        self.md5 = None  # (source, split), if compared
+        self.md5_method = None
+        self.error = None
+
+    def result(self):
+        if self.error is not None:
+            return 'ERROR'
+        if (self.samples[0] != self.samples[1] or
+                (self.md5 is not None and self.md5[0] != self.md5[1])):
+            return 'MISMATCH'
+        return 'MATCH'
+
+    def samples_text(self):
+        if self.samples is None:
+            return '-'
+        if self.samples[0] == self.samples[1]:
+            return str(self.samples[0])
+        return '{} != {}'.format(*self.samples)
+
+    def md5_text(self):
+        if self.error is not None:
+            return self.error
+        if self.md5 is None:
+            return '-'
+        return '{}, {}'.format(self.md5_method,
+                'same' if self.md5[0] == self.md5[1] else 'differs')
+
+# Audio that FLAC/MP3 probing doesn't handle is described by sox instead.
+def split_meta(filename, sox_infos):
+    if filename not in sox_infos:
+        return probe_file(filename, None)
+    info = sox_infos[filename]
+    if 'Total Samples' not in info:
+        raise ValueError('sox could not read the file')
+    return FileMeta(filename, flac.FLACMeta(info['Sample Rate'],
+            info['Total Samples'], info['Channels'],
+            bits_per_sample = info.get('Bit Precision')))
+
+def verify_split(source, split_filename, sox_infos, compare_md5 = True):
+    check = SplitCheck(source, split_filename)
+    try:
+        split = split_meta(split_filename, sox_infos)
+        check.samples = (source.meta.total_samples, split.meta.total_samples)
+        if compare_md5 and check.samples[0] == check.samples[1]:
+            # compared at the greater depth if they differ, so a track that
+            # was only padded still matches
+            bits = max(getattr(track.meta, 'bits_per_sample', None) or
+                    DEFAULT_DECODE_BITS for track in [source, split])
+            source_md5, source_method = audio_md5(source, bits)
+            split_md5, split_method = audio_md5(split, bits)
+            check.md5 = (source_md5, split_md5)
+            check.md5_method = (source_method if source_method == split_method
+                    else 'mixed')
+    except (RuntimeError, ValueError, OSError) as error:
+        check.error = str(error)
+    return check
+
+def print_split_summary(checks):
+    rows = [('#', 'RESULT', 'SAMPLES', 'AUDIO MD5', 'FILE')]
+    for index, check in enumerate(checks):
+        rows.append((str(index + 1), check.result(), check.samples_text(),
+                check.md5_text(), os.path.basename(check.source.filename)))
+    widths = [max(len(row[column]) for row in rows)
+            for column in range(len(rows[0]) - 1)]
+    for row in rows:
+        print('  '.join(text.ljust(width)
+                for text, width in zip(row, widths)) + '  ' + row[-1])
+    results = [check.result() for check in checks]
+    print('{} tracks: {} matched, {} mismatched, {} errors'.format(
+            len(checks), results.count('MATCH'), results.count('MISMATCH'),
+            results.count('ERROR')))
+
+# Compares each source track with the file at the same position (by name) in
+# split_dir: their sample counts and, unless samples_only, the MD5 of their
+# decoded audio.  FLAC MD5s come from STREAMINFO, so FLAC on both sides is
+# checked without decoding anything.  Tracks are checked up to jobs at a
+# time.  Returns 0 if every one matched.
+def check_split_accuracy(source_dir, split_dir, jobs = 1,
+        samples_only = False):
+    audio_type, tracks, images = scanDirectory(source_dir, None, jobs)
+    split_files = [os.path.join(split_dir, basename)
+            for basename in sorted(os.listdir(split_dir))
+            if os.path.splitext(basename)[1].lower() not in IMAGE_EXTENSIONS]
 
     if len(tracks) != len(split_files):
         raise RuntimeError('Number of tracks/files does not match.')
 
-    for i in range(len(tracks)):
-        sox = subprocess.Popen(['sox', '--info', os.path.join(split_dir,
-                split_files[i])], stdout = subprocess.PIPE)
-        output = sox.communicate()[0].decode(sys.getdefaultencoding())
-        sox.wait()
-        
-        start = output.find('=', output.find('\nDuration')) + 2
-        end = output.find(' samples', start)
-
-        if tracks[i].total_samples != int(output[start:end]):
-            raise ValueError('Mismatch in {}'.format(tracks[i].filename))
-        print('MATCH: {}'.format(tracks[i].filename))
-
-    return 0
-
-
-
-    
+    others = [filename for filename in split_files
+            if os.path.splitext(filename)[1].lower() not in AUDIO_EXTENSIONS]
+    sox_infos = dict(zip(others, util.sox_info_all(others)))
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        checks = list(executor.map(lambda pair: verify_split(pair[0],
+                pair[1], sox_infos, not samples_only),
+                zip(tracks, split_files)))
 
+    print_split_summary(checks)
+    return 0 if all(check.result() == 'MATCH' for check in checks) else 1
 
 # ./album_merge.py prepare input/ staging/
 # # check xml and files
 # ./album_merge.py assemble staging/ output/  
+# or both at once, without writing the merged audio to staging/ (though
+# the FLAC stream then has no MD5 or seek table, see build_mkv):
+# ./album_merge.py build input/ staging/
 # NOTE: still have to do album replay gain scan with foobar2000, because
 # metaflac uses an older inferior algorithm
 def main():
-    PREPARE, ASSEMBLE, CHECKSPLIT = range(3)
-    fail = False
-    sample_rate = None
-    channels = None
-    if len(sys.argv) in [4, 5, 6]:
-        arg = sys.argv[1].lower()
-        if arg == 'prepare':
-            command = PREPARE
-        elif arg == 'assemble':
-            command = ASSEMBLE
-        elif arg == 'checksplit':
-            command = CHECKSPLIT
-        else:
-            raise ValueError('Unknown command: {}'.format(command))
-        source_dir = sys.argv[2]
-        dest_dir = sys.argv[3]
-
-        if len(sys.argv) >= 5:
-            if command != PREPARE:
-                fail = True
-            else:
-                sample_rate = int(sys.argv[4])
-                if len(sys.argv) >= 6:
-                    channels = int(sys.argv[5])
-    else:
-        fail = True
-
-    if fail:
-        raise ValueError('Invalid arguments.')
-
-    if command == PREPARE: 
-        exit_code = prepare_flac_album(source_dir, dest_dir, sample_rate,
-                channels)
-    elif command == ASSEMBLE:
-        exit_code = assemble_mkv(source_dir, dest_dir)
-    elif command == CHECKSPLIT:
-        split_dir = dest_dir
-        exit_code = check_split_accuracy(source_dir, split_dir)
+    parser = argparse.ArgumentParser(description='Merges album tracks into a'
+            ' single chaptered matroska audio file.', epilog='build streams'
+            ' the merged audio into the muxer, converting mismatched FLAC'
+            ' tracks inline and re-encoding serially, so no FLAC audio is'
+            ' written to disk; the streamed FLAC has no STREAMINFO MD5 or seek'
+            ' table, and is seeked by its Matroska cues instead.')
+    parser.add_argument('command', choices=['prepare', 'assemble', 'build',
+            'checksplit'], type=str.lower)
+    parser.add_argument('source_dir')
+    parser.add_argument('dest_dir')
+    parser.add_argument('sample_rate', nargs='?', type=int)
+    parser.add_argument('channels', nargs='?', type=int)
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs(),
+            help='number of files to probe or encode concurrently'
+            ' (prepare/build/checksplit); 1 encodes serially, as build'
+            ' always does')
+    parser.add_argument('--tool-limit', metavar='TOOL=N', action='append',
+            type=runner.parse_limit, default=[],
+            help='run at most N of an external tool (such as sox) at once,'
+            ' within the overall --jobs limit; may be repeated')
+    parser.add_argument('--reencode', action='store_true',
+            help='always decode and re-encode FLAC input (prepare/build),'
+            ' rather than joining the existing frames when the formats match')
+    parser.add_argument('--inline-resample', action='store_true',
+            help='convert mismatched FLAC tracks while merging (prepare; build'
+            ' always does), rather than writing resampled copies to dest_dir'
+            ' first')
+    parser.add_argument('--mkvmerge', action='store_true',
+            help='assemble with mkvmerge rather than the native Matroska'
+            ' writer (assemble)')
+    parser.add_argument('--samples-only', action='store_true',
+            help='compare only sample counts, not the MD5 of the audio'
+            ' (checksplit)')
+    parser.add_argument('--no-cache', action='store_true',
+            help='probe every file, bypassing the persistent probe cache')
+    parser.add_argument('--cache-file', default=None,
+            help='probe cache location (default: {})'.format(
+                    cache.default_path()))
+    args = parser.parse_args()
+
+    if (args.sample_rate is not None and
+            args.command not in ['prepare', 'build']):
+        parser.error('sample_rate/channels are only valid for prepare/build')
+
+    runner.configure(args.jobs, dict(args.tool_limit))
+    if not args.no_cache and args.command != 'assemble':
+        cache.set_active(cache.ProbeCache(args.cache_file))
+
+    if args.command == 'prepare':
+        exit_code = prepare_flac_album(args.source_dir, args.dest_dir,
+                args.sample_rate, args.channels, jobs=args.jobs,
+                reencode=args.reencode,
+                inline_resample=args.inline_resample)
+    elif args.command == 'assemble':
+        exit_code = assemble_mkv(args.source_dir, args.dest_dir,
+                native=not args.mkvmerge)
+    elif args.command == 'build':
+        exit_code = build_mkv(args.source_dir, args.dest_dir,
+                args.sample_rate, args.channels, jobs=args.jobs,
+                reencode=args.reencode)
+    elif args.command == 'checksplit':
+        split_dir = args.dest_dir
+        exit_code = check_split_accuracy(args.source_dir, split_dir,
+                jobs=args.jobs, samples_only=args.samples_only)
+
+    probe_cache = cache.active()
+    if probe_cache is not None:
+        print(probe_cache.summary())
+        probe_cache.close()
 
     return exit_code
 
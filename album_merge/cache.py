@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+# bump this whenever the pickled probe results change shape
+VERSION = 5
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+def default_path():
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'album_merge', 'probe.sqlite')
+
+# Persistent cache of probe results (file metadata, sox --info output, etc),
+# keyed by the kind of probe and the real path of the file.  An entry is only
+# used if the size, mtime and inode of the file still match, so any change to
+# the file invalidates it.  Least recently used entries are evicted once the
+# stored results exceed max_bytes.  Access times of hits are only noted in
+# memory, and written together by flush() (or close()), rather than
+# committing once per hit.
+class ProbeCache(object):
+    def __init__(self, path = None, max_bytes = DEFAULT_MAX_BYTES):
+        if path is None:
+            path = default_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # probes are run from a thread pool
+        self._lock = threading.Lock()
+        self._accessed = {}  # (kind, path): time, of hits not yet flushed
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != VERSION:
+            self._db.execute('DROP TABLE IF EXISTS probe')
+            self._db.execute('PRAGMA user_version = {}'.format(VERSION))
+        self._db.execute('CREATE TABLE IF NOT EXISTS probe ('
+                ' kind TEXT NOT NULL, path TEXT NOT NULL,'
+                ' size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,'
+                ' inode INTEGER NOT NULL, accessed REAL NOT NULL,'
+                ' result BLOB NOT NULL, PRIMARY KEY (kind, path))')
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.close()
+
+    # Writes the access times of the hits since the last flush, in one
+    # transaction.
+    def flush(self):
+        with self._lock:
+            self._flush()
+            self._db.commit()
+
+    def _flush(self):
+        if self._accessed:
+            self._db.executemany('UPDATE probe SET accessed = ?'
+                    ' WHERE kind = ? AND path = ?',
+                    [(accessed, kind, path) for (kind, path), accessed
+                            in self._accessed.items()])
+            self._accessed = {}
+
+    def summary(self):
+        return 'Probe cache: {} hits, {} misses'.format(self.hits, self.misses)
+
+    # Returns the cached result of probe() for the file, running and storing
+    # it if there is no valid entry.
+    def lookup(self, kind, filename, probe):
+        return self.lookup_many(kind, [filename],
+                lambda missing: [probe()])[0]
+
+    # Returns the cached results for the files, in order, with those that
+    # have no valid entry coming from one call of probe_all(missing
+    # filenames), which returns their results in the same order.
+    def lookup_many(self, kind, filenames, probe_all):
+        results = []
+        missing = []
+        for filename in filenames:
+            path = os.path.realpath(filename)
+            stat = os.stat(path)
+            identity = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            found, result = self._get(kind, path, identity)
+            if not found:
+                missing.append((len(results), filename, path, identity))
+            results.append(result)
+        if not missing:
+            return results
+
+        # probe without holding the lock, so other threads can proceed
+        probed = probe_all([filename for index, filename, path, identity
+                in missing])
+        with self._lock:
+            for (index, filename, path, identity), result in zip(
+                    missing, probed):
+                results[index] = result
+                blob = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+                self._db.execute('INSERT OR REPLACE INTO probe VALUES'
+                        ' (?, ?, ?, ?, ?, ?, ?)',
+                        (kind, path) + identity + (time.time(), blob))
+            self._evict()
+            self._db.commit()
+        return results
+
+    # (True, result) for a valid entry, otherwise (False, None)
+    def _get(self, kind, path, identity):
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, inode, result'
+                    ' FROM probe WHERE kind = ? AND path = ?',
+                    (kind, path)).fetchone()
+            if row is not None and tuple(row[:3]) == identity:
+                try:
+                    result = pickle.loads(row[3])
+                except Exception:
+                    pass  # unreadable; treat it as a miss
+                else:
+                    self.hits += 1
+                    self._accessed[(kind, path)] = time.time()
+                    return (True, result)
+            self.misses += 1
+        return (False, None)
+
+    def _evict(self):
+        self._flush()  # so recent hits aren't evicted as unused
+        total = self._db.execute(
+                'SELECT COALESCE(SUM(LENGTH(result)), 0) FROM probe'
+                ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for kind, path, length in self._db.execute('SELECT kind, path,'
+                ' LENGTH(result) FROM probe ORDER BY accessed').fetchall():
+            self._db.execute('DELETE FROM probe WHERE kind = ? AND path = ?',
+                    (kind, path))
+            total -= length
+            if total <= self.max_bytes:
+                break
+
+# The cache used by cached(), if any; probes go uncached until one is set.
+_active = None
+
+def set_active(probe_cache):
+    global _active
+    _active = probe_cache
+
+def active():
+    return _active
+
+def cached(kind, filename, probe):
+    if _active is None:
+        return probe()
+    return _active.lookup(kind, filename, probe)
+
+def flush():
+    if _active is not None:
+        _active.flush()
+
+def cached_many(kind, filenames, probe_all):
+    if _active is None:
+        return probe_all(filenames)
+    return _active.lookup_many(kind, filenames, probe_all)
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
 import enum
+import os
 import sys
-import subprocess
 
 import util
+import runner
 import hashlib
 
 class PictureType(enum.IntEnum):
@@ -49,7 +50,7 @@ class Picture(object):
                 self.description == other.description)
 
     def __ne__(self, other):
-        return not self.eq(other)
+        return not self.__eq__(other)
 
     def __hash__(self):
         return hash((self.digest, self.description))
@@ -157,104 +158,428 @@ class MetaListParser(object):
             self.current_field = next_field
         return completed_field
 
+    # Parses an entire listing at once, yielding the same fields as feeding
+    # process_line one line at a time.  Continuation lines are collected and
+    # joined once per field instead of being appended to the value, which is
+    # quadratic for long values such as lyrics or picture dumps.
+    @staticmethod
+    def parse_buffer(text):
+        key = None
+        level = 0
+        parts = None
+        lines = text.split('\n')
+        if not lines[-1]:
+            lines.pop()  # trailing newline, not an empty last line
+        for line in lines:
+            if line.endswith('\r'):
+                line = line[:-1]
+            stripped = line.lstrip(' ')
+            next_level = (len(line) - len(stripped)) // 2
+            next_key = None
+            if next_level == 0:
+                # see process_line regarding these restrictions
+                if line.startswith(BLOCK_PREFIX):
+                    next_key = BLOCK_PREFIX
+                    next_value = line[len(BLOCK_PREFIX):]
+            elif abs(level - next_level) <= 1:
+                colon = line.find(':')
+                if colon != -1:
+                    next_key = line[:colon].strip()
+                    next_value = line[colon + 1:]
+                    if next_value.startswith(' '):
+                        next_value = next_value[1:]
+            if next_key is None:
+                if key is None:
+                    raise ValueError('Unexpected line: ' + line + '\n')
+                parts.append(line)
+            else:
+                if key is not None:
+                    yield MetaField(level, key, '\n'.join(parts))
+                key = next_key
+                level = next_level
+                parts = [next_value]
+        if key is not None:
+            yield MetaField(level, key, '\n'.join(parts))
+
 # perhaps do picture meta separately
 
+FLAC_MARKER = b'fLaC'
+
+class BlockHeader(object):
+    def __init__(self, last, block_type, offset, length):
+        self.last = last
+        self.block_type = block_type
+        self.offset = offset  # of the block data, past the 4-byte header
+        self.length = length
+
+# Skips an ID3v2 tag if one is present (some taggers prepend one to flac
+# files, and metaflac tolerates it), then verifies the stream marker.  Leaves
+# the handle positioned at the first metadata block header.
+def skip_to_metadata(handle):
+    start = handle.tell()
+    handle.seek(start + util.id3v2_length(handle.read(10)))
+    if handle.read(4) != FLAC_MARKER:
+        raise ValueError('Not a FLAC stream.')
+
+# Yields a BlockHeader for each metadata block.  The consumer may read from
+# the handle at will; it is repositioned to the next header before resuming.
+def metadata_blocks(handle):
+    skip_to_metadata(handle)
+    while True:
+        header = handle.read(4)
+        if len(header) != 4:
+            raise ValueError('Truncated metadata block header.')
+        last = bool(header[0] & 0x80)
+        length = int.from_bytes(header[1:4], 'big')
+        block = BlockHeader(last, header[0] & 0x7F, handle.tell(), length)
+        yield block
+        if block.last:
+            break
+        handle.seek(block.offset + block.length)
+
+def read_exact(handle, size):
+    data = handle.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated metadata block.')
+    return data
+
+def read_uint32(handle, byteorder='big'):
+    return int.from_bytes(read_exact(handle, 4), byteorder)
+
+def read_utf8(handle, size):
+    # metaflac is run with --no-utf8-convert and its output decoded as such,
+    # so decode identically; the line parser also folds CRLF to LF.
+    return read_exact(handle, size).decode('utf-8').replace('\r\n', '\n')
+
 class FLACMeta(object):
 
     def __init__(self, sample_rate, total_samples, channels,
-            comments = None, pictures = None):
+            comments = None, pictures = None, bits_per_sample = None,
+            md5 = None):
         self.sample_rate = sample_rate
         self.total_samples = total_samples
         self.channels = channels
         self.comments = comments
         self.pictures = pictures
+        self.bits_per_sample = bits_per_sample
+        self.md5 = md5  # of the decoded audio, all zeros if unknown
 
+    # Reads the metadata blocks directly, falling back to metaflac if the
+    # file couldn't be parsed natively.
+    @staticmethod
+    def from_file(filename, digest_map = None, native = True):
+        if native:
+            try:
+                return FLACMeta.from_native(filename, digest_map)
+            except ValueError as error:  # including UnicodeDecodeError
+                print('Native FLAC read failed ({}), using metaflac: {}'.format(
+                        error, filename), file=sys.stderr)
+        return FLACMeta.from_metaflac(filename, digest_map)
+
+    # data is a util.FileRange/util.BufferRange, which is only stored if the
+    # digest hasn't been seen before.
     @staticmethod
-    def from_file(filename, digest_map = None):
+    def add_picture(pictures, digest_map, picture_type, description, digest,
+            data):
+        if digest not in digest_map:
+            digest_map[digest] = data
+        # append the digest to the list if not present
+        # using list instead of set for defined order.
+        picture = Picture(digest, description)
+        picture_list = pictures.get(picture_type, [])
+        if picture not in picture_list:
+            picture_list.append(picture)
+        pictures[picture_type] = picture_list
+
+    @staticmethod
+    def from_native(filename, digest_map = None):
         sample_rate = None
         total_samples = None
         comments = {}
         pictures = {}
         channels = 0
-
-        parser = MetaListParser()
+        bits_per_sample = None
+        md5 = None
+
+        with open(filename, 'rb') as handle:
+            for block in metadata_blocks(handle):
+                if block.block_type == BlockType.STREAMINFO:
+                    data = read_exact(handle, 34)
+                    # skipping block and frame sizes (10 bytes), then:
+                    # <20> sample rate, <3> channels-1, <5> bps-1,
+                    # <36> total samples, <128> md5
+                    packed = int.from_bytes(data[10:18], 'big')
+                    sample_rate = packed >> 44
+                    channels = ((packed >> 41) & 0x07) + 1
+                    bits_per_sample = ((packed >> 36) & 0x1F) + 1
+                    total_samples = packed & 0xFFFFFFFFF
+                    md5 = bytes(data[18:34])
+                elif block.block_type == BlockType.VORBIS_COMMENT:
+                    # vorbis comments are little-endian, unlike the rest
+                    handle.seek(read_uint32(handle, 'little'), 1)  # vendor
+                    for i in range(read_uint32(handle, 'little')):
+                        entry = read_utf8(handle,
+                                read_uint32(handle, 'little'))
+                        key, value = entry.split('=', 1)
+                        comments[key] = value
+                elif (block.block_type == BlockType.PICTURE and
+                        digest_map is not None):
+                    picture_type = PictureType(read_uint32(handle))
+                    handle.seek(read_uint32(handle), 1)  # mime type
+                    description = read_utf8(handle, read_uint32(handle))
+                    # skip width, height, depth and colors
+                    handle.seek(16, 1)
+                    length = read_uint32(handle)
+                    offset = handle.tell()
+                    # hash it straight from the file rather than keeping it
+                    digest = util.range_digest(handle, offset, length)
+                    FLACMeta.add_picture(pictures, digest_map, picture_type,
+                            description, digest.digest(),
+                            util.FileRange(filename, offset, length))
+        if sample_rate is None:
+            raise ValueError('Missing STREAMINFO block.')
+        return FLACMeta(sample_rate, total_samples, channels, comments,
+                pictures, bits_per_sample, md5)
+
+    # Parses the output of metaflac --list
+    @staticmethod
+    def from_metaflac(filename, digest_map = None):
+        sample_rate = None
+        total_samples = None
+        comments = {}
+        pictures = {}
+        channels = 0
+        bits_per_sample = None
+        md5 = None
 
         desired = [BlockType.STREAMINFO, BlockType.VORBIS_COMMENT]
         if digest_map is not None:
             desired.append(BlockType.PICTURE)
 
-        child = subprocess.Popen(['metaflac',
+        child = runner.run(['metaflac',
                 '--list', '--no-utf8-convert',
                 '--block-type=' + ','.join([value.name for value in desired]),
-                filename], stdin = subprocess.DEVNULL,
-                stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+                filename], capture = True, quiet = True,
+                timeout = runner.PROBE_TIMEOUT, check = False)
 
         block_type = None
 
-        for line in util.line_reader(child.stdout, terminate=True):
-            # after last line, we'll get None because terminate is True
-            field = parser.process_line(line)  # None will flush
-            if field is not None:
-                # processing
-                if field.level == 0 and field.key == BLOCK_PREFIX:
-                    block_type = None  # num = field.int_value()
-                elif block_type is None and field.key == 'type':
-                    block_type = BlockType(field.int_value())
-                    if block_type == BlockType.PICTURE:
+        output = child.stdout.decode(sys.getdefaultencoding())
+        for field in MetaListParser.parse_buffer(output):
+            # processing
+            if field.level == 0 and field.key == BLOCK_PREFIX:
+                block_type = None  # num = field.int_value()
+            elif block_type is None and field.key == 'type':
+                block_type = BlockType(field.int_value())
+                if block_type == BlockType.PICTURE:
+                    picture_bytes = 0
+                    picture_type = None
+                    picture_data = None
+                    picture_mime = None
+                    picture_description = None
+            elif block_type == BlockType.STREAMINFO:
+                if field.key == 'sample_rate':
+                    sample_rate = field.int_value()
+                elif field.key == 'total samples':
+                    total_samples = field.int_value()
+                elif field.key == 'channels':
+                    channels = field.int_value()
+                elif field.key == 'bits-per-sample':
+                    bits_per_sample = field.int_value()
+                elif field.key == 'MD5 signature':
+                    md5 = bytes.fromhex(field.value)
+            elif block_type == BlockType.VORBIS_COMMENT:
+                if (field.key.startswith('comment[') and
+                        field.key.endswith(']')):
+                    key, value = field.value.split('=', 1)
+                    comments[key] = value
+            elif block_type == BlockType.PICTURE:
+                if field.key == 'data length':
+                    picture_bytes = field.int_value()
+                elif field.key == 'type':
+                    picture_type = PictureType(field.int_value())
+                elif field.key == 'data':
+                    picture_data = bytearray()
+                    picture_digest = hashlib.sha1()
+                elif field.key == 'description':
+                    picture_description = field.value
+                elif (picture_bytes != 0 and field.key ==
+                        '{:08X}'.format(len(picture_data))):
+                    row = bytes.fromhex(field.value[:3 * min(16,
+                            picture_bytes - len(picture_data))])
+                    picture_digest.update(row)
+                    picture_data += row
+                    if len(picture_data) == picture_bytes:
+                        # metaflac doesn't report the offset of the data,
+                        # so this fallback has to keep its own copy.
+                        FLACMeta.add_picture(pictures, digest_map,
+                                picture_type, picture_description,
+                                picture_digest.digest(),
+                                util.BufferRange(picture_data))
                         picture_bytes = 0
-                        picture_type = None
-                        picture_data = None
-                        picture_mime = None
-                        picture_description = None
-                elif block_type == BlockType.STREAMINFO:
-                    if field.key == 'sample_rate':
-                        sample_rate = field.int_value()
-                    elif field.key == 'total samples':
-                        total_samples = field.int_value()
-                    elif field.key == 'channels':
-                        channels = field.int_value()
-                elif block_type == BlockType.VORBIS_COMMENT:
-                    if (field.key.startswith('comment[') and
-                            field.key.endswith(']')):
-                        key, value = field.value.split('=', 1)
-                        comments[key] = value
-                elif block_type == BlockType.PICTURE:
-                    if field.key == 'data length':
-                        picture_bytes = field.int_value()
-                    elif field.key == 'type':
-                        picture_type = PictureType(field.int_value())
-                    elif field.key == 'data':
-                        picture_data = bytearray()
-                    elif field.key == 'description':
-                        picture_description = field.value
-                    elif (picture_bytes != 0 and field.key ==
-                            '{:08X}'.format(len(picture_data))):
-                        picture_data += bytearray.fromhex(
-                                field.value[:3 * min(16,
-                                        picture_bytes - len(picture_data))])
-                        if len(picture_data) == picture_bytes:
-                            # Add the image to the database, storing the digest
-                            digest = hashlib.sha1(picture_data).digest()
-                            if digest not in digest_map:
-                                digest_map[digest] = picture_data
-                            picture_bytes = 0
-                            picture_data = None # allow freeing
-                            # append the digest to the list if not present
-                            # using list instead of set for defined order.
-                            picture = Picture(digest, picture_description)
-                            picture_list = pictures.get(picture_type, [])
-                            if picture not in picture_list:
-                                picture_list.append(picture)
-                            pictures[picture_type] = picture_list
-        child.wait()
-        return FLACMeta(sample_rate, total_samples, channels, comments, pictures)
+                        picture_data = None # allow freeing
+        return FLACMeta(sample_rate, total_samples, channels, comments,
+                pictures, bits_per_sample, md5)
+
+def meta_differences(lhs, rhs, lhs_map, rhs_map):
+    differences = []
+    for attribute in ['sample_rate', 'total_samples', 'channels', 'comments',
+            'pictures', 'bits_per_sample', 'md5']:
+        if getattr(lhs, attribute) != getattr(rhs, attribute):
+            differences.append(attribute)
+    # keyed by the digest of the data, so the keys are enough to compare
+    if set(lhs_map) != set(rhs_map):
+        differences.append('picture data')
+    return differences
+
+# Generates a metaflac-style listing of roughly the given number of lines,
+# with a picture dump and a long multi-line lyrics comment.
+def synthetic_listing(lines = 10000):
+    rows = lines // 2
+    listing = [
+            'METADATA block #0', '  type: 0 (STREAMINFO)', '  is last: false',
+            '  length: 34', '  sample_rate: 44100 Hz', '  channels: 2',
+            '  total samples: 1234567',
+            'METADATA block #1', '  type: 4 (VORBIS_COMMENT)',
+            '  is last: false', '  comments: 2',
+            '    comment[0]: TITLE=Synthetic',
+            '    comment[1]: UNSYNCEDLYRICS=first line']
+    listing.extend('lyric line {}: with a colon'.format(i)
+            for i in range(rows))
+    listing.extend(['METADATA block #2', '  type: 6 (PICTURE)',
+            '  is last: true', '  description: cover',
+            '  data length: {}'.format(16 * (lines - rows)), '  data:'])
+    listing.extend('    {:08X}: {}'.format(16 * i, ' '.join(['AB'] * 16))
+            for i in range(lines - rows))
+    return '\n'.join(listing) + '\n'
+
+def benchmark_parser(lines = 10000, repeat = 5):
+    import timeit
+    text = synthetic_listing(lines)
+
+    def per_line():
+        parser = MetaListParser()
+        fields = []
+        for line in text.splitlines(True) + [None]:
+            field = parser.process_line(line)
+            if field is not None:
+                fields.append(field)
+        return fields
+
+    def bulk():
+        return list(MetaListParser.parse_buffer(text))
+
+    if [repr(field) for field in per_line()] != [
+            repr(field) for field in bulk()]:
+        raise RuntimeError('Parsers produced different fields.')
+    for name, function in [('process_line', per_line),
+            ('parse_buffer', bulk)]:
+        best = min(timeit.repeat(function, number=1, repeat=repeat))
+        print('{}: {:.2f} ms for {} lines'.format(name, best * 1000, lines))
+    return 0
 
+def metadata_block(block_type, data, last = False):
+    return (bytes([(0x80 if last else 0) | block_type]) +
+            len(data).to_bytes(3, 'big') + data)
+
+# The metadata of a FLAC stream (without any audio) holding the given
+# STREAMINFO fields, comments and (picture type, mime type, description,
+# data) pictures.
+def synthetic_metadata(sample_rate, channels, bits_per_sample,
+        total_samples, md5, comments, pictures):
+    packed = ((sample_rate << 44) | ((channels - 1) << 41) |
+            ((bits_per_sample - 1) << 36) | total_samples)
+    streaminfo = (bytes(10) + packed.to_bytes(8, 'big') + md5)
+    entries = [(key + '=' + value).encode('utf-8')
+            for key, value in comments.items()]
+    vendor = b'synthetic'
+    vorbis_comment = (len(vendor).to_bytes(4, 'little') + vendor +
+            len(entries).to_bytes(4, 'little') + b''.join(
+                    len(entry).to_bytes(4, 'little') + entry
+                    for entry in entries))
+    blocks = [metadata_block(BlockType.STREAMINFO, streaminfo),
+            metadata_block(BlockType.VORBIS_COMMENT, vorbis_comment)]
+    for index, (picture_type, mime, description, data) in enumerate(pictures):
+        description = description.encode('utf-8')
+        fields = [int(picture_type).to_bytes(4, 'big'),
+                len(mime).to_bytes(4, 'big'), mime.encode('ascii'),
+                len(description).to_bytes(4, 'big'), description,
+                bytes(16), len(data).to_bytes(4, 'big'), data]
+        blocks.append(metadata_block(BlockType.PICTURE, b''.join(fields),
+                index == len(pictures) - 1))
+    return FLAC_MARKER + b''.join(blocks)
+
+# Round trips synthetic metadata through the native reader (and metaflac,
+# if it is installed), returning the number of failures.
+def self_test():
+    import shutil
+    import tempfile
+    md5 = bytes(range(16))
+    comments = {'TITLE': 'Synthetic', 'ARTIST': 'A=B',
+            'UNSYNCEDLYRICS': 'first line\nsecond: with a colon'}
+    front = b'front cover ' * 100
+    pictures = [(PictureType.COVER_FRONT, 'image/jpeg', 'cover', front),
+            (PictureType.COVER_BACK, 'image/png', '', b'back cover'),
+            (PictureType.COVER_FRONT, 'image/jpeg', 'again', front)]
+    expected_pictures = {
+        PictureType.COVER_FRONT: [
+                Picture(hashlib.sha1(front).digest(), 'cover'),
+                Picture(hashlib.sha1(front).digest(), 'again')],
+        PictureType.COVER_BACK: [
+                Picture(hashlib.sha1(b'back cover').digest(), '')]}
+    expected = FLACMeta(96000, 1234567890, 6, comments, expected_pictures,
+            24, md5)
+    expected_data = {hashlib.sha1(data).digest(): data
+            for _, _, _, data in pictures}
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'synthetic.flac')
+        util.write_file(filename, synthetic_metadata(96000, 6, 24,
+                1234567890, md5, comments, pictures))
+        readers = [('native', FLACMeta.from_native)]
+        if shutil.which('metaflac'):
+            readers.append(('metaflac', FLACMeta.from_metaflac))
+        for name, reader in readers:
+            digest_map = {}
+            meta = reader(filename, digest_map)
+            differences = meta_differences(meta, expected, digest_map,
+                    expected_data)
+            if any(data.read() != expected_data[digest]
+                    for digest, data in digest_map.items()
+                    if digest in expected_data):
+                differences.append('picture bytes')
+            if differences:
+                failures += 1
+                print('FAIL: {}: {}'.format(name, ', '.join(differences)))
+            else:
+                print('PASS: {}'.format(name))
+    return failures
+
+# Parity check of the native reader against metaflac:
+#   ./flac.py file.flac [file.flac ...]
+# Or a round trip of synthetic metadata through the readers:
+#   ./flac.py --self-test
+# Or a benchmark of the metaflac listing parsers:
+#   ./flac.py --benchmark
 def main():
-    digest_map = {}
-    filename = 'type2/Greydon Square - Type II - The Mandelbrot Set - 01 Galaxy Rise.flac'
-    filename = 'out/test.flac'
-    flac = FLACMeta(filename, digest_map)
-    return 0
+    if sys.argv[1:] == ['--benchmark']:
+        return benchmark_parser()
+    if sys.argv[1:] == ['--self-test']:
+        return int(self_test() != 0)
+    mismatches = 0
+    for filename in sys.argv[1:]:
+        native_map = {}
+        metaflac_map = {}
+        native = FLACMeta.from_native(filename, native_map)
+        metaflac = FLACMeta.from_metaflac(filename, metaflac_map)
+        differences = meta_differences(native, metaflac,
+                native_map, metaflac_map)
+        if differences:
+            mismatches += 1
+            print('MISMATCH: {}: {}'.format(filename, ', '.join(differences)))
+        else:
+            print('MATCH: {}'.format(filename))
+    return int(mismatches != 0)
 
 if __name__ == '__main__':
   sys.exit(main())
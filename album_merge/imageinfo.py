@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import struct
+
+# Reads the format and dimensions of an image from its header, so that
+# covers needn't be run through identify.  The probes take read(offset,
+# length), returning up to length bytes of the image from offset, and return
+# (format, width, height) with the format named as identify's %m would name
+# it (in lower case), or None for anything they don't understand.
+
+HEAD_LENGTH = 32
+
+PNG_MARKER = b'\x89PNG\r\n\x1a\n'
+GIF_MARKERS = [b'GIF87a', b'GIF89a']
+JPEG_MARKER = b'\xFF\xD8'
+
+# start of frame markers, other than DHT, JPG and DAC which share the range
+JPEG_SOF = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+# markers without a length
+JPEG_STANDALONE = set(range(0xD0, 0xD8)) | set([0x01])
+JPEG_EOI = 0xD9
+JPEG_SOS = 0xDA
+
+def probe_png(head, read):
+    if head[12:16] != b'IHDR':
+        return None
+    width, height = struct.unpack('>II', head[16:24])
+    return ('png', width, height)
+
+def probe_gif(head, read):
+    width, height = struct.unpack('<HH', head[6:10])
+    return ('gif', width, height)
+
+def probe_bmp(head, read):
+    header_size = struct.unpack('<I', head[14:18])[0]
+    if header_size == 12:  # OS/2 BITMAPCOREHEADER
+        width, height = struct.unpack('<HH', head[18:22])
+    else:
+        width, height = struct.unpack('<ii', head[18:26])
+    # negative heights are stored top-down
+    return ('bmp', abs(width), abs(height))
+
+def probe_webp(head, read):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        # lossy: after the frame tag and start code, 14 bits each
+        if head[23:26] != b'\x9D\x01\x2A':
+            return None
+        width, height = struct.unpack('<HH', head[26:30])
+        return ('webp', width & 0x3FFF, height & 0x3FFF)
+    if chunk == b'VP8L':
+        # lossless: 14 bits each of width - 1 and height - 1
+        if head[20] != 0x2F:
+            return None
+        bits = struct.unpack('<I', head[21:25])[0]
+        return ('webp', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b'VP8X':
+        # extended: 24 bits each of the canvas width - 1 and height - 1
+        return ('webp', int.from_bytes(head[24:27], 'little') + 1,
+                int.from_bytes(head[27:30], 'little') + 1)
+    return None
+
+# The frame header can follow any number of (large, for EXIF thumbnails or
+# ICC profiles) segments, which are skipped over rather than read.
+def probe_jpeg(head, read):
+    offset = len(JPEG_MARKER)
+    while True:
+        marker = bytes(read(offset, 4))
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if code in JPEG_STANDALONE:
+            offset += 2
+            continue
+        if code in [JPEG_EOI, JPEG_SOS] or len(marker) < 4:
+            return None  # no frame header before the image data
+        if code in JPEG_SOF:
+            frame = bytes(read(offset + 4, 5))
+            if len(frame) < 5:
+                return None
+            precision, height, width = struct.unpack('>BHH', frame)
+            if not width or not height:  # height may be defined later
+                return None
+            return ('jpeg', width, height)
+        offset += 2 + struct.unpack('>H', marker[2:4])[0]
+
+def probe(read):
+    head = bytes(read(0, HEAD_LENGTH))
+    if len(head) < HEAD_LENGTH:
+        return None
+    if head.startswith(JPEG_MARKER):
+        return probe_jpeg(head, read)
+    if head.startswith(PNG_MARKER):
+        return probe_png(head, read)
+    if head[:6] in GIF_MARKERS:
+        return probe_gif(head, read)
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return probe_webp(head, read)
+    if head.startswith(b'BM'):
+        return probe_bmp(head, read)
+    return None
+
+def probe_data(data):
+    return probe(lambda offset, length: data[offset:offset + length])
+
+def probe_file(filename):
+    with open(filename, 'rb') as handle:
+        def read(offset, length):
+            handle.seek(offset)
+            return handle.read(length)
+        return probe(read)
@@ -386,7 +386,7 @@ class Tag(Node):
 
     def chapter_uid(self):
         value = self._chapter_uid.text
-        if value is not None:
+        if value:  # '' once removed
             return int(value)
         return 0
 
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+import mimetypes
+import mmap
+import os
+import struct
+import uuid
+
+import markup
+import mp3
+import stitch
+import uid
+import util
+
+# Writes audio-only Matroska (.mka) files without mkvmerge: a single FLAC or
+# MPEG track, plus the chapters, tags and attachments from the markup objects.
+# Frames are written a cluster at a time as they are read, and the few fields
+# only known at the end (segment size, duration, the seek head) are patched
+# in place, so the output must be a seekable file.
+# https://www.matroska.org/technical/elements.html
+
+# element ids
+EBML = 0x1A45DFA3
+EBML_VERSION = 0x4286
+EBML_READ_VERSION = 0x42F7
+EBML_MAX_ID_LENGTH = 0x42F2
+EBML_MAX_SIZE_LENGTH = 0x42F3
+DOC_TYPE = 0x4282
+DOC_TYPE_VERSION = 0x4287
+DOC_TYPE_READ_VERSION = 0x4285
+VOID = 0xEC
+
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+
+INFO = 0x1549A966
+SEGMENT_UID = 0x73A4
+TIMESTAMP_SCALE = 0x2AD7B1
+DURATION = 0x4489
+MUXING_APP = 0x4D80
+WRITING_APP = 0x5741
+
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_UID = 0x73C5
+TRACK_TYPE = 0x83
+FLAG_DEFAULT = 0x88
+FLAG_LACING = 0x9C
+DEFAULT_DURATION = 0x23E383
+LANGUAGE = 0x22B59C
+CODEC_ID = 0x86
+CODEC_PRIVATE = 0x63A2
+AUDIO = 0xE1
+SAMPLING_FREQUENCY = 0xB5
+CHANNELS = 0x9F
+BIT_DEPTH = 0x6264
+
+CLUSTER = 0x1F43B675
+TIMESTAMP = 0xE7
+SIMPLE_BLOCK = 0xA3
+
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+CUE_CLUSTER_POSITION = 0xF1
+
+ATTACHMENTS = 0x1941A469
+ATTACHED_FILE = 0x61A7
+FILE_DESCRIPTION = 0x467E
+FILE_NAME = 0x466E
+FILE_MIME_TYPE = 0x4660
+FILE_DATA = 0x465C
+FILE_UID = 0x46AE
+
+CHAPTERS = 0x1043A770
+EDITION_ENTRY = 0x45B9
+EDITION_UID = 0x45BC
+EDITION_FLAG_HIDDEN = 0x45BD
+EDITION_FLAG_DEFAULT = 0x45DB
+CHAPTER_ATOM = 0xB6
+CHAPTER_UID = 0x73C4
+CHAPTER_TIME_START = 0x91
+CHAPTER_FLAG_HIDDEN = 0x98
+CHAPTER_FLAG_ENABLED = 0x4598
+CHAPTER_DISPLAY = 0x80
+CHAP_STRING = 0x85
+CHAP_LANGUAGE = 0x437C
+
+TAGS = 0x1254C367
+TAG = 0x7373
+TARGETS = 0x63C0
+TARGET_TYPE_VALUE = 0x68CA
+TARGET_TYPE = 0x63CA
+TAG_CHAPTER_UID = 0x63C4
+SIMPLE_TAG = 0x67C8
+TAG_NAME = 0x45A3
+TAG_LANGUAGE = 0x447A
+TAG_DEFAULT = 0x4484
+TAG_STRING = 0x4487
+
+APP_NAME = 'album_merge'
+TRACK = 1
+TIMESTAMP_SCALE_NS = 1000000  # timestamps in milliseconds
+CLUSTER_MS = 5000
+CLUSTER_BYTES = 5 * 1024 * 1024
+# a seek position is always written at full width, so the seek head can be
+# reserved up front and filled in at the end
+POSITION_WIDTH = 8
+# left after the seek head, so that tools editing the file in place (such as
+# mkvpropedit) have room to add entries to it
+SEEK_HEAD_PADDING = 256
+
+def encode_id(element_id):
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+# The size as an EBML variable-length integer, in the fewest bytes unless a
+# width is given.  The all-ones value of each width is reserved.
+def encode_size(size, width = None):
+    if width is None:
+        width = 1
+        while size >= (1 << (7 * width)) - 1:
+            width += 1
+    elif size >= (1 << (7 * width)) - 1:
+        raise ValueError('Size {} needs more than {} bytes.'.format(
+                size, width))
+    return ((1 << (7 * width)) | size).to_bytes(width, 'big')
+
+def header(element_id, size, width = None):
+    return encode_id(element_id) + encode_size(size, width)
+
+def element(element_id, payload):
+    return header(element_id, len(payload)) + payload
+
+def master(element_id, children):
+    return element(element_id, b''.join(children))
+
+def uint(element_id, value, width = None):
+    if width is None:
+        width = max(1, (value.bit_length() + 7) // 8)
+    return element(element_id, value.to_bytes(width, 'big'))
+
+def double(element_id, value):
+    return element(element_id, struct.pack('>d', value))
+
+def string(element_id, value):
+    return element(element_id, (value or '').encode('utf-8'))
+
+def ebml_header():
+    return master(EBML, [
+        uint(EBML_VERSION, 1),
+        uint(EBML_READ_VERSION, 1),
+        uint(EBML_MAX_ID_LENGTH, 4),
+        uint(EBML_MAX_SIZE_LENGTH, 8),
+        string(DOC_TYPE, 'matroska'),
+        uint(DOC_TYPE_VERSION, 4),
+        uint(DOC_TYPE_READ_VERSION, 2)])
+
+def seek_head(positions):
+    return master(SEEK_HEAD, [master(SEEK, [
+                element(SEEK_ID, encode_id(element_id)),
+                uint(SEEK_POSITION, position, POSITION_WIDTH)])
+            for element_id, position in positions])
+
+def chapters_element(chapter_file):
+    atoms = []
+    for child in chapter_file.chapters().children():
+        chapter = markup.Chapter(element=child)
+        children = [
+            uint(CHAPTER_UID, chapter.uid()),
+            uint(CHAPTER_TIME_START, chapter.start_time().nanoseconds),
+            uint(CHAPTER_FLAG_HIDDEN, int(chapter.hidden())),
+            uint(CHAPTER_FLAG_ENABLED, int(chapter.enabled()))]
+        if chapter.name():
+            children.append(master(CHAPTER_DISPLAY, [
+                string(CHAP_STRING, chapter.name()),
+                string(CHAP_LANGUAGE, chapter.name_language())]))
+        atoms.append(master(CHAPTER_ATOM, children))
+    return master(CHAPTERS, [master(EDITION_ENTRY, [
+        uint(EDITION_UID, chapter_file.uid()),
+        uint(EDITION_FLAG_HIDDEN, int(chapter_file.hidden())),
+        uint(EDITION_FLAG_DEFAULT, int(chapter_file.default()))] + atoms)])
+
+def tags_element(tag_file):
+    tags = []
+    for child in tag_file.tags().children():
+        tag = markup.Tag(element=child)
+        targets = []
+        if tag.target_type_value():
+            targets.append(uint(TARGET_TYPE_VALUE,
+                    int(tag.target_type_value())))
+        if tag.target_type():
+            targets.append(string(TARGET_TYPE, tag.target_type()))
+        if tag.chapter_uid():
+            targets.append(uint(TAG_CHAPTER_UID, tag.chapter_uid()))
+        fields = []
+        for field_element in tag.fields().children():
+            field = markup.Field(element=field_element)
+            fields.append(master(SIMPLE_TAG, [
+                string(TAG_NAME, field.name()),
+                string(TAG_LANGUAGE, field.language()),
+                uint(TAG_DEFAULT, int(field.default_language())),
+                string(TAG_STRING, field.value())]))
+        tags.append(master(TAG, [master(TARGETS, targets)] + fields))
+    return master(TAGS, tags)
+
+# The attachments to write: (picture, path) for each picture of the
+# PictureFile, whose filenames are relative to picture_dir.
+def picture_attachments(picture_file, picture_dir):
+    return [(picture, os.path.join(picture_dir, picture.filename()))
+            for picture in (markup.Picture(element=child)
+                    for child in picture_file.pictures().children())]
+
+# The codec parameters of the one audio track.
+class Track(object):
+    def __init__(self, codec_id, sample_rate, channels, bits_per_sample = None,
+            codec_private = None, samples_per_frame = None):
+        self.codec_id = codec_id
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+        self.codec_private = codec_private
+        self.samples_per_frame = samples_per_frame  # if constant
+
+    def element(self):
+        audio = [double(SAMPLING_FREQUENCY, float(self.sample_rate)),
+                uint(CHANNELS, self.channels)]
+        if self.bits_per_sample is not None:
+            audio.append(uint(BIT_DEPTH, self.bits_per_sample))
+        children = [
+            uint(TRACK_NUMBER, TRACK),
+            uint(TRACK_UID, uid.generate() or 1),
+            uint(TRACK_TYPE, 2),  # audio
+            uint(FLAG_DEFAULT, 1),
+            uint(FLAG_LACING, 0),
+            string(LANGUAGE, 'eng'),
+            string(CODEC_ID, self.codec_id)]
+        if self.codec_private is not None:
+            children.append(element(CODEC_PRIVATE, self.codec_private))
+        if self.samples_per_frame is not None:
+            children.append(uint(DEFAULT_DURATION, round(
+                    self.samples_per_frame * 1000000000 / self.sample_rate)))
+        children.append(master(AUDIO, audio))
+        return master(TRACKS, [master(TRACK_ENTRY, children)])
+
+class Writer(object):
+    def __init__(self, filename, track, chapter_file = None, tag_file = None,
+            attachments = None):
+        self.track = track
+        self.samples = 0
+        self._cluster = []  # (timestamp, frame) not yet written
+        self._cluster_bytes = 0
+        self._cues = []  # (timestamp, cluster position)
+        self._positions = []  # (element id, position) for the seek head
+        self._handle = open(filename, 'wb')
+        try:
+            self._handle.write(ebml_header())
+            self._handle.write(header(SEGMENT, 0, 8))
+            self._segment = self._handle.tell()
+
+            expected = [INFO, TRACKS, CUES]
+            if attachments:
+                expected.append(ATTACHMENTS)
+            if chapter_file is not None:
+                expected.append(CHAPTERS)
+            if tag_file is not None:
+                expected.append(TAGS)
+            self._seek_head = self._handle.tell()
+            self._handle.write(seek_head((element_id, 0)
+                    for element_id in expected))
+            self._handle.write(header(VOID, SEEK_HEAD_PADDING - 9, 8) +
+                    bytes(SEEK_HEAD_PADDING - 9))
+
+            info = master(INFO, [
+                uint(TIMESTAMP_SCALE, TIMESTAMP_SCALE_NS),
+                string(MUXING_APP, APP_NAME),
+                string(WRITING_APP, APP_NAME),
+                element(SEGMENT_UID, uuid.uuid4().bytes),
+                double(DURATION, 0.0)])
+            # the duration is last, so its value ends the element
+            self._duration = self._handle.tell() + len(info) - 8
+            self._write_top_level(INFO, info)
+            self._write_top_level(TRACKS, track.element())
+            if attachments:
+                self._write_attachments(attachments)
+            if chapter_file is not None:
+                self._write_top_level(CHAPTERS, chapters_element(chapter_file))
+            if tag_file is not None:
+                self._write_top_level(TAGS, tags_element(tag_file))
+        except BaseException:
+            self._handle.close()
+            raise
+
+    def _position(self):
+        return self._handle.tell() - self._segment
+
+    def _write_top_level(self, element_id, data):
+        self._positions.append((element_id, self._position()))
+        self._handle.write(data)
+
+    # The files are copied in blocks, rather than read whole.
+    def _write_attachments(self, attachments):
+        files = []
+        uids = uid.Group()
+        for picture, path in attachments:
+            size = os.path.getsize(path)
+            mime_type = mimetypes.guess_type(path)[0]
+            fields = []
+            if picture.description():
+                fields.append(string(FILE_DESCRIPTION, picture.description()))
+            fields.extend([
+                string(FILE_NAME, picture.name()),
+                string(FILE_MIME_TYPE,
+                        mime_type or 'application/octet-stream'),
+                uint(FILE_UID, uids.generate() or 1)])
+            fields = b''.join(fields)
+            data_header = header(FILE_DATA, size)
+            files.append((path, size, fields, data_header))
+        self._positions.append((ATTACHMENTS, self._position()))
+        self._handle.write(header(ATTACHMENTS, sum(
+                len(header(ATTACHED_FILE, length)) + length
+                for length in (len(fields) + len(data_header) + size
+                        for path, size, fields, data_header in files))))
+        for path, size, fields, data_header in files:
+            self._handle.write(header(ATTACHED_FILE,
+                    len(fields) + len(data_header) + size))
+            self._handle.write(fields)
+            self._handle.write(data_header)
+            with open(path, 'rb') as source:
+                copied = 0
+                for block in util.range_reader(source, size):
+                    self._handle.write(block)
+                    copied += len(block)
+            if copied != size:
+                raise ValueError('Attachment changed size: ' + path)
+
+    def _timestamp(self, samples):
+        return (samples * 1000 + self.track.sample_rate // 2) // (
+                self.track.sample_rate)
+
+    def add_frame(self, samples, frame):
+        timestamp = self._timestamp(self.samples)
+        if self._cluster and (timestamp - self._cluster[0][0] >= CLUSTER_MS or
+                self._cluster_bytes >= CLUSTER_BYTES):
+            self._write_cluster()
+        self._cluster.append((timestamp, frame))
+        self._cluster_bytes += len(frame)
+        self.samples += samples
+
+    def _write_cluster(self):
+        start = self._cluster[0][0]
+        blocks = [header(SIMPLE_BLOCK, 4 + len(frame)) +
+                encode_size(TRACK) + struct.pack('>hB', timestamp - start,
+                        0x80)  # keyframe
+                for timestamp, frame in self._cluster]
+        time = uint(TIMESTAMP, start)
+        self._cues.append((start, self._position()))
+        self._handle.write(header(CLUSTER, len(time) + sum(
+                len(block) + len(frame) for block, (timestamp, frame) in
+                zip(blocks, self._cluster))))
+        self._handle.write(time)
+        for block, (timestamp, frame) in zip(blocks, self._cluster):
+            self._handle.write(block)
+            self._handle.write(frame)
+        self._cluster = []
+        self._cluster_bytes = 0
+
+    def finish(self):
+        try:
+            if self._cluster:
+                self._write_cluster()
+            self._write_top_level(CUES, master(CUES, [master(CUE_POINT, [
+                    uint(CUE_TIME, timestamp),
+                    master(CUE_TRACK_POSITIONS, [
+                        uint(CUE_TRACK, TRACK),
+                        uint(CUE_CLUSTER_POSITION, position)])])
+                for timestamp, position in self._cues]))
+            end = self._handle.tell()
+            self._handle.seek(self._segment - 8)
+            self._handle.write(encode_size(end - self._segment, 8))
+            self._handle.seek(self._seek_head)
+            self._handle.write(seek_head(self._positions))
+            self._handle.seek(self._duration)
+            self._handle.write(struct.pack('>d', self.samples * 1000 /
+                    self.track.sample_rate))
+        finally:
+            self._handle.close()
+
+# Returns the Track of a FLAC or MP3 file, and a generator of its
+# (samples, frame) pairs, read from a mapping of the file.
+def open_audio(filename):
+    if filename.lower().endswith('.flac'):
+        return open_flac(filename)
+    return open_mp3(filename)
+
+def open_flac(filename):
+    info = stitch.StreamInfo.from_file(filename)
+    with open(filename, 'rb') as handle:
+        handle.seek(util.id3v2_length(handle.read(10)))
+        # the stream header and metadata blocks
+        codec_private = handle.read(info.audio_offset - handle.tell())
+    track = Track('A_FLAC', info.sample_rate, info.channels,
+            info.bits_per_sample, codec_private)
+
+    def frames():
+        with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0,
+                access=mmap.ACCESS_READ) as data:
+            for offset, length, frame_header in stitch.stream_frames(data,
+                    info):
+                yield (frame_header.block_size, data[offset:offset + length])
+    return (track, frames())
+
+def open_mp3(filename):
+    with open(filename, 'rb') as handle:
+        try:
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError('Empty file.')
+    end = mp3.audio_end(data)
+    offset, first = mp3.find_frame(data, util.id3v2_length(data[:10]), end)
+    if first is None:
+        data.close()
+        raise ValueError('No MPEG audio frames found.')
+    if mp3.is_vbr_header(data, offset, first):
+        offset += first.length()
+    track = Track('A_MPEG/L{}'.format(first.layer), first.sample_rate,
+            first.channels, samples_per_frame=first.samples())
+
+    def frames():
+        with data:
+            for frame_offset, frame_header in mp3.frames(data, offset, end):
+                yield (frame_header.samples(), data[frame_offset:
+                        frame_offset + frame_header.length()])
+    return (track, frames())
+
+# Writes the audio file, chapters, tags and pictures (see
+# picture_attachments) to output_filename.
+def write_file(output_filename, audio_filename, chapter_file = None,
+        tag_file = None, attachments = None):
+    track, frames = open_audio(audio_filename)
+    try:
+        writer = Writer(output_filename, track, chapter_file, tag_file,
+                attachments)
+        try:
+            for samples, frame in frames:
+                writer.add_frame(samples, frame)
+        finally:
+            writer.finish()
+    finally:
+        frames.close()
+    return writer
@@ -1,20 +1,291 @@
 #!/usr/bin/env python3
 
-import subprocess
+import mmap
+import sys
 
 import util
 
+# kbps, indexed by [version is MPEG1][layer][bitrate index]
+BIT_RATES = {
+    True: {
+        1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416,
+                448],
+        2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    },
+    False: {
+        1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    },
+}
+
+# indexed by the version bits: MPEG2.5, reserved, MPEG2, MPEG1
+SAMPLE_RATES = [[11025, 12000, 8000], None, [22050, 24000, 16000],
+        [44100, 48000, 32000]]
+
+XING_MARKERS = [b'Xing', b'Info']
+LAME_MARKER = b'LAME'
+VBRI_MARKER = b'VBRI'
+
+class FrameHeader(object):
+    def __init__(self, mpeg1, layer, bit_rate, sample_rate, padding, channels,
+            side_info_length):
+        self.mpeg1 = mpeg1
+        self.layer = layer
+        self.bit_rate = bit_rate  # kbps
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.channels = channels
+        self.side_info_length = side_info_length
+
+    def samples(self):
+        if self.layer == 1:
+            return 384
+        if self.layer == 3 and not self.mpeg1:
+            return 576
+        return 1152
+
+    def length(self):
+        if self.layer == 1:
+            return (12000 * self.bit_rate // self.sample_rate +
+                    self.padding) * 4
+        return (self.samples() // 8 * 1000 * self.bit_rate //
+                self.sample_rate + self.padding)
+
+    # Returns None if the 4 bytes at offset aren't a usable frame header.
+    # Free-format (bitrate index 0) frames aren't supported.
+    @staticmethod
+    def parse(data, offset):
+        if offset + 4 > len(data):
+            return None
+        b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+        if data[offset] != 0xFF or (b1 & 0xE0) != 0xE0:
+            return None
+        version = (b1 >> 3) & 0x03
+        layer = 4 - ((b1 >> 1) & 0x03)
+        bit_rate_index = b2 >> 4
+        sample_rate_index = (b2 >> 2) & 0x03
+        if (version == 1 or layer == 4 or bit_rate_index in [0, 15] or
+                sample_rate_index == 3):
+            return None
+        mpeg1 = (version == 3)
+        mono = ((b3 >> 6) == 3)
+        if mpeg1:
+            side_info_length = 17 if mono else 32
+        else:
+            side_info_length = 9 if mono else 17
+        return FrameHeader(mpeg1, layer,
+                BIT_RATES[mpeg1][layer][bit_rate_index],
+                SAMPLE_RATES[version][sample_rate_index],
+                (b2 >> 1) & 0x01, 1 if mono else 2, side_info_length)
+
+ID3V1_MARKER = b'TAG'
+ID3V1_LENGTH = 128
+APE_MARKER = b'APETAGEX'
+APE_FOOTER_LENGTH = 32
+APE_HAS_HEADER = 0x80000000
+
+# Returns True if the frame at offset is a Xing/Info/LAME or VBRI header
+# frame, rather than audio.
+def is_vbr_header(data, offset, header):
+    xing = offset + 4 + header.side_info_length
+    vbri = offset + 4 + 32
+    return (data[xing:xing + 4] in XING_MARKERS or
+            data[vbri:vbri + 4] == VBRI_MARKER)
+
+# Returns the audio frame count from a Xing/Info/LAME or VBRI header in the
+# frame at offset, or None if it has neither (or no frame count).
+def vbr_header_frames(data, offset, header):
+    xing = offset + 4 + header.side_info_length
+    if data[xing:xing + 4] in XING_MARKERS:
+        flags = int.from_bytes(data[xing + 4:xing + 8], 'big')
+        if flags & 0x01:
+            return int.from_bytes(data[xing + 8:xing + 12], 'big')
+        return None
+    vbri = offset + 4 + 32
+    if data[vbri:vbri + 4] == VBRI_MARKER:
+        return int.from_bytes(data[vbri + 14:vbri + 18], 'big')
+    return None
+
+# Returns the encoder delay plus padding (in samples) recorded by the LAME
+# extension of a Xing/Info header in the frame at offset, or 0 if it has none.
+def lame_gapless_samples(data, offset, header):
+    xing = offset + 4 + header.side_info_length
+    if data[xing:xing + 4] not in XING_MARKERS:
+        return 0
+    flags = int.from_bytes(data[xing + 4:xing + 8], 'big')
+    position = xing + 8
+    for flag, length in [(0x01, 4), (0x02, 4), (0x04, 100), (0x08, 4)]:
+        if flags & flag:  # frames, bytes, TOC, quality
+            position += length
+    if data[position:position + 4] != LAME_MARKER:
+        return 0
+    gapless = data[position + 21:position + 24]
+    if len(gapless) != 3:
+        return 0
+    # 12 bits each of delay and padding
+    return ((gapless[0] << 4 | gapless[1] >> 4) +
+            ((gapless[1] & 0x0F) << 8 | gapless[2]))
+
+# Returns the offset just past the last byte that may hold audio frames,
+# excluding trailing ID3v1 and APE tags.
+def audio_end(data):
+    end = len(data)
+    if data[end - ID3V1_LENGTH:end - ID3V1_LENGTH + 3] == ID3V1_MARKER:
+        end -= ID3V1_LENGTH
+    footer = end - APE_FOOTER_LENGTH
+    if footer >= 0 and data[footer:footer + 8] == APE_MARKER:
+        # the size includes the footer, but not the optional header
+        end -= int.from_bytes(data[footer + 12:footer + 16], 'little')
+        if int.from_bytes(data[footer + 20:footer + 24], 'little') & (
+                APE_HAS_HEADER):
+            end -= APE_FOOTER_LENGTH
+    return max(end, 0)
+
+# Finds the first frame header in [offset, end) that is followed by another
+# valid header (or the end), to avoid syncing on stray 0xFF bytes.
+def find_frame(data, offset, end):
+    while True:
+        offset = data.find(b'\xFF', offset, end)
+        if offset == -1:
+            return (None, None)
+        header = FrameHeader.parse(data, offset)
+        if header is not None:
+            following = offset + header.length()
+            if (following == end or (following < end and
+                    FrameHeader.parse(data, following) is not None)):
+                return (offset, header)
+        offset += 1
+
+# Yields (offset, header) for each audio frame in [offset, end), resyncing
+# past anything that isn't one (such as APE tags).
+def frames(data, offset, end):
+    while True:
+        header = FrameHeader.parse(data, offset)
+        if header is None or offset + header.length() > end:
+            offset, header = find_frame(data, offset + 1, end)
+            if header is None:
+                break
+        yield (offset, header)
+        offset += header.length()
+
+# Returns (first frame header, total samples, gapless trim), counting samples
+# without decoding: from the VBR header if present, otherwise by walking
+# every frame.  Frames are counted as decoded, without the gapless (LAME
+# delay/padding) trim, which is returned separately; see MP3Meta.
+def scan_frames(data):
+    end = audio_end(data)
+    offset, first = find_frame(data, util.id3v2_length(data[:10]), end)
+    if first is None:
+        raise ValueError('No MPEG audio frames found.')
+    frame_count = vbr_header_frames(data, offset, first)
+    if frame_count is not None:
+        return (first, frame_count * first.samples(),
+                lame_gapless_samples(data, offset, first))
+
+    if is_vbr_header(data, offset, first):
+        offset += first.length()  # not audio
+    total_samples = 0
+    for offset, header in frames(data, offset, end):
+        total_samples += header.samples()
+    # without a frame count, the header's trim can't be trusted to still apply
+    return (first, total_samples, 0)
+
+# The audio frames of a file, as a list of contiguous (offset, length) byte
+# ranges, excluding tags and any VBR header frame.
+class FrameRanges(object):
+    def __init__(self, data):
+        self.ranges = []
+        self.frames = 0
+        self.total_samples = 0
+        self.bit_rates = set()
+        self.sample_rate = None
+        self.channels = None
+
+        end = audio_end(data)
+        offset, first = find_frame(data, util.id3v2_length(data[:10]), end)
+        if first is None:
+            raise ValueError('No MPEG audio frames found.')
+        self.sample_rate = first.sample_rate
+        self.channels = first.channels
+        if is_vbr_header(data, offset, first):
+            offset += first.length()
+        for offset, header in frames(data, offset, end):
+            length = header.length()
+            if self.ranges and sum(self.ranges[-1]) == offset:
+                self.ranges[-1] = (self.ranges[-1][0],
+                        self.ranges[-1][1] + length)
+            else:
+                self.ranges.append((offset, length))
+            self.frames += 1
+            self.total_samples += header.samples()
+            self.bit_rates.add(header.bit_rate)
+
+    def length(self):
+        return sum(length for offset, length in self.ranges)
+
+    # The bit rate in kbps if constant, otherwise None.
+    def bit_rate(self):
+        if len(self.bit_rates) == 1:
+            return next(iter(self.bit_rates))
+        return None
+
+    @staticmethod
+    def from_file(filename):
+        with open(filename, 'rb') as handle:
+            try:
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError('Empty file.')
+            with data:
+                return FrameRanges(data)
+
+# total_samples counts every frame in full, unlike duration.py (which
+# applies the gapless trim, as the ffmpeg decode it falls back to does).
+# That's what is needed here: prepare strips the LAME header when merging, so
+# every frame of every track is decoded in full and the chapter offsets have
+# to count them all.  The trim is kept in gapless_trim, for the length as a
+# gapless player would report it.
 class MP3Meta(object):
     def __init__(self, sample_rate, total_samples, channels,
-            comments = None, pictures = None):
+            comments = None, pictures = None, gapless_trim = 0):
         self.sample_rate = sample_rate
         self.total_samples = total_samples
         self.channels = channels
         self.comments = comments
         self.pictures = pictures
+        self.gapless_trim = gapless_trim
+
+    def gapless_samples(self):
+        return max(self.total_samples - self.gapless_trim, 0)
+
+    # Scans the frames natively, falling back to sox if that fails.
+    @staticmethod
+    def from_file(filename, digest_map = None, native = True):
+        if native:
+            try:
+                return MP3Meta.from_native(filename, digest_map)
+            except ValueError as error:
+                print('Native MP3 scan failed ({}), using sox: {}'.format(
+                        error, filename), file=sys.stderr)
+        return MP3Meta.from_sox(filename, digest_map)
 
     @staticmethod
-    def from_file(filename, digest_map = None):
+    def from_native(filename, digest_map = None):
+        with open(filename, 'rb') as handle:
+            try:
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError('Empty file.')
+            with data:
+                header, total_samples, gapless_trim = scan_frames(data)
+        # ID3 tags aren't read, so MP3 tracks have no comments or pictures
+        return MP3Meta(header.sample_rate, total_samples, header.channels,
+                {}, {}, gapless_trim)
+
+    @staticmethod
+    def from_sox(filename, digest_map = None):
         sample_rate = None
         total_samples = None
         channels = None
@@ -27,11 +298,16 @@ class MP3Meta(object):
         # TODO: tags and stuff
         return MP3Meta(sample_rate, total_samples, channels, comments, pictures)
 
+# Writes only the audio frames of the input to the output, dropping ID3v1,
+# ID3v2 and APE tags as well as the LAME/Xing info frame, which no longer
+# applies once files are concatenated.  The frames are copied in the kernel.
+# Returns the FrameRanges that were written, or None on failure.
 def strip_all_metadata(input_filename, output_filename):
-    retval = False
+    try:
+        ranges = FrameRanges.from_file(input_filename)
+    except ValueError:
+        return None
     with open(input_filename, 'rb') as infile, open(output_filename, 'wb') as outfile:
-        child = subprocess.Popen(['extract_frames', '--noinfo'],
-                stdin=infile, stdout = outfile, stderr = subprocess.DEVNULL)
-        retval = (child.wait() == 0)
-    return retval
-
+        for offset, length in ranges.ranges:
+            util.copy_range(infile.fileno(), outfile.fileno(), offset, length)
+    return ranges
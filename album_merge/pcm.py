@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import fcntl
+import queue
+import subprocess
+import threading
+import time
+
+# Streams the raw PCM output of a sequence of decoder processes into a
+# single encoder process.  Each decoder's output is read into a fixed ring
+# of preallocated buffers by a reader thread of its own, and a worker thread
+# publishes the buffers in track order for the caller's thread to drain into
+# the encoder's stdin.  The next track's decoder and reader are started as
+# soon as the current track's are, so the next track is decoded into the
+# ring (up to PREFETCH_SLOTS buffers of it) while the current one is still
+# being encoded, and the encoder isn't left waiting between tracks.
+
+RING_SLOTS = 16
+SLOT_SIZE = 1024 * 1024
+PIPE_SIZE = 1024 * 1024
+# how much of the ring the next track may fill before the current one ends;
+# the rest is left for the current track
+PREFETCH_SLOTS = RING_SLOTS // 2
+# how often a blocked reader checks whether it has been stopped
+STOP_POLL_SECONDS = 0.1
+
+# Grows a pipe's kernel buffer, so fewer context switches are needed per
+# byte; silently left alone where that isn't possible (non-Linux, or
+# exceeding /proc/sys/fs/pipe-max-size).
+def enlarge_pipe(handle, size = PIPE_SIZE):
+    try:
+        fcntl.fcntl(handle.fileno(), fcntl.F_SETPIPE_SZ, size)
+    except (AttributeError, OSError):
+        pass
+
+# The raw PCM format produced by the decoders and expected by the encoder.
+class Format(object):
+    def __init__(self, sample_rate, channels, bits_per_sample):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+
+    # req sox
+    # converting the track if its format differs
+    def decode_command(self, filename):
+        return ['sox', filename, '-t', 'raw', '-e', 'signed-integer',
+                '-b', str(self.bits_per_sample), '-L', '-',
+                'channels', str(self.channels), 'rate', str(self.sample_rate)]
+
+    # req flac
+    # writing to stdout if output is None
+    def encode_command(self, options, output):
+        return (['flac', '--force-raw-format', '--endian=little',
+                '--sign=signed', '--channels={}'.format(self.channels),
+                '--bps={}'.format(self.bits_per_sample),
+                '--sample-rate={}'.format(self.sample_rate)] + options +
+                (['--stdout'] if output is None else ['-o', output]) + ['-'])
+
+class RingBuffer(object):
+    def __init__(self, slots = RING_SLOTS, slot_size = SLOT_SIZE):
+        self._slots = [memoryview(bytearray(slot_size))
+                for i in range(slots)]
+        self._free = queue.Queue()
+        for index in range(slots):
+            self._free.put(index)
+        self._filled = queue.Queue()
+
+    def slot(self, index):
+        return self._slots[index]
+
+    # producer side: blocks until a slot is free, or returns None once
+    # stopped is set
+    def acquire(self, stopped):
+        while not stopped.is_set():
+            try:
+                return self._free.get(timeout=STOP_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        return None
+
+    def publish(self, index, length):
+        self._filled.put((index, length))
+
+    # publishes a marker, such as the end of a track, instead of data
+    def publish_marker(self, marker):
+        self._filled.put((None, marker))
+
+    # consumer side: blocks until there is data or a marker
+    def take(self):
+        return self._filled.get()
+
+    def release(self, index):
+        self._free.put(index)
+
+END_OF_TRACK = 'end of track'
+END_OF_STREAM = 'end of stream'
+
+# Byte/time counters for one side of the pipeline.
+class Counter(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.bytes = 0
+        self.waiting = 0.0  # seconds spent blocked on the other side
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.bytes / elapsed if elapsed else 0
+
+    def summary(self, label):
+        return '{}: {:.1f} MiB at {:.1f} MiB/s, {:.1f}s waiting'.format(
+                label, self.bytes / (1 << 20), self.rate() / (1 << 20),
+                self.waiting)
+
+# Reads a decoder's output into ring slots on a thread of its own, queueing
+# (slot, length) in filled for the worker to publish, and finally (None,
+# decoder exit code), or (None, None) if stopped.  At most PREFETCH_SLOTS
+# slots are queued at once, so a reader that is only reading ahead can't
+# take the slots the current track needs.
+class TrackReader(object):
+    def __init__(self, decoder, ring, counter, stopped):
+        self.decoder = decoder
+        self.filled = queue.Queue()
+        self._ring = ring
+        self._counter = counter
+        self._stopped = stopped
+        self._queued = threading.BoundedSemaphore(PREFETCH_SLOTS)
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _acquire(self):
+        waited = time.perf_counter()
+        try:
+            while not self._queued.acquire(timeout=STOP_POLL_SECONDS):
+                if self._stopped.is_set():
+                    return None
+            slot = self._ring.acquire(self._stopped)
+            if slot is None:
+                self._queued.release()
+            return slot
+        finally:
+            self._counter.waiting += time.perf_counter() - waited
+
+    def _read(self):
+        result = None
+        try:
+            while True:
+                slot = self._acquire()
+                if slot is None:
+                    return
+                length = self.decoder.stdout.readinto(self._ring.slot(slot))
+                if not length or self._stopped.is_set():
+                    self._ring.release(slot)
+                    self._queued.release()
+                    if length:
+                        return
+                    break
+                self._counter.bytes += length
+                self.filled.put((slot, length))
+            self.decoder.stdout.close()
+            result = self.decoder.wait()
+        finally:
+            self.filled.put((None, result))
+
+    # called by the worker once it has published a slot from filled
+    def published(self):
+        self._queued.release()
+
+    def kill(self):
+        if self.decoder.poll() is None:
+            self.decoder.kill()
+
+    def join(self):
+        self._thread.join()
+        self.decoder.wait()
+
+class Concatenator(object):
+    def __init__(self, filenames, pcm_format, encoder, progress = None):
+        self.filenames = filenames
+        self.format = pcm_format
+        self.encoder = encoder  # a Popen with stdin=PIPE
+        self.progress = progress  # called with (track index, self)
+        self.decoded = Counter()
+        self.encoded = Counter()
+        self.error = None
+        self._ring = RingBuffer()
+        self._stopped = threading.Event()
+
+    def _spawn(self, index):
+        decoder = subprocess.Popen(
+                self.format.decode_command(self.filenames[index]),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE)  # print errors to terminal
+        enlarge_pipe(decoder.stdout)
+        return decoder
+
+    def _reader(self, index):
+        if index >= len(self.filenames):
+            return None
+        return TrackReader(self._spawn(index), self._ring, self.decoded,
+                self._stopped)
+
+    def _decode(self):
+        readers = []
+        try:
+            readers.append(self._reader(0))
+            for index in range(len(self.filenames)):
+                # the next track is read ahead while this one is published
+                readers.append(self._reader(index + 1))
+                reader = readers[index]
+                while True:
+                    slot, value = reader.filled.get()
+                    if slot is None:
+                        break
+                    self._ring.publish(slot, value)
+                    reader.published()
+                # the decoder's exit code
+                if value is None:
+                    raise RuntimeError('Stopped.')
+                if value != 0:
+                    raise RuntimeError('Error decoding ' +
+                            self.filenames[index])
+                self._ring.publish_marker(END_OF_TRACK)
+        except Exception as error:
+            self.error = error
+            self._stopped.set()
+            for reader in readers:
+                if reader is not None:
+                    reader.kill()
+        finally:
+            for reader in readers:
+                if reader is not None:
+                    reader.join()
+            self._ring.publish_marker(END_OF_STREAM)
+
+    # Streams every track into the encoder, then closes its stdin.  Raises
+    # the first decoding error, if any; the encoder's exit code is the
+    # caller's to check.
+    def run(self):
+        enlarge_pipe(self.encoder.stdin)
+        worker = threading.Thread(target=self._decode, daemon=True)
+        worker.start()
+        track = 0
+        try:
+            while True:
+                waited = time.perf_counter()
+                slot, length = self._ring.take()
+                self.encoded.waiting += time.perf_counter() - waited
+                if slot is None:
+                    if length == END_OF_STREAM:
+                        break
+                    if self.progress is not None:
+                        self.progress(track, self)
+                    track += 1
+                    continue
+                self.encoder.stdin.write(self._ring.slot(slot)[:length])
+                self.encoded.bytes += length
+                self._ring.release(slot)
+        except BaseException:
+            # stop the worker, freeing slots until it has
+            self._stopped.set()
+            while True:
+                slot, length = self._ring.take()
+                if slot is not None:
+                    self._ring.release(slot)
+                elif length == END_OF_STREAM:
+                    break
+            raise
+        finally:
+            self.encoder.stdin.close()
+            worker.join()
+        if self.error is not None:
+            raise self.error
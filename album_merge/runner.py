@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import asyncio
+import threading
+import subprocess
+
+# Runs external tools (sox, metaflac, identify, ...) as asyncio subprocesses
+# on an event loop of its own, so that any thread can use them.  At most
+# `jobs` tools run at once overall, and each tool can be limited further, so
+# that (say) sox conversions don't take every core while metaflac probes run.
+
+# for probes, which only read headers and shouldn't take this long
+PROBE_TIMEOUT = 120
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+class ToolError(RuntimeError):
+    def __init__(self, args, message):
+        super().__init__('{}: {}'.format(os.path.basename(args[0]), message))
+        self.command = args
+
+class Runner(object):
+    # limits maps tool names (the basename of args[0]) to their own limit
+    def __init__(self, jobs = None, limits = None):
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.limits = dict(limits or {})
+        self._lock = threading.Lock()
+        self._loop = None
+        self._semaphores = None
+
+    def _event_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever,
+                        name='runner', daemon=True)
+                thread.start()
+                self._loop = loop
+            return self._loop
+
+    # only called from the loop, so needs no lock
+    def _semaphore(self, tool):
+        if self._semaphores is None:
+            self._semaphores = {None: asyncio.Semaphore(self.jobs)}
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(
+                    min(self.jobs, max(1, self.limits.get(tool, self.jobs))))
+        return self._semaphores[tool]
+
+    # Runs the command once a slot for it is free, returning a
+    # subprocess.CompletedProcess.  input is written to its stdin.  Its
+    # stdout is passed line by line (decoded) to on_line as it is read if
+    # given, returned if capture, and discarded otherwise; on_line may
+    # return True to ignore the rest.  on_data is like on_line, but is
+    # passed blocks of raw bytes (for audio, say).  stderr goes to the
+    # terminal unless quiet.  Raises ToolError if it fails (and check) or
+    # runs for longer than timeout seconds, and kills it if cancelled.
+    async def run_async(self, args, input = None, on_line = None,
+            on_data = None, capture = False, quiet = False, timeout = None,
+            check = True):
+        tool = os.path.basename(args[0])
+        async with self._semaphore(tool), self._semaphore(None):
+            child = await asyncio.create_subprocess_exec(*args,
+                    stdin=subprocess.DEVNULL if input is None else
+                            subprocess.PIPE,
+                    stdout=subprocess.PIPE if on_line or on_data or capture
+                            else subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL if quiet else None)
+            try:
+                output = await asyncio.wait_for(
+                        Runner._communicate(child, input, on_line, on_data),
+                        timeout)
+            except asyncio.TimeoutError:
+                Runner._kill(child)
+                await child.wait()
+                raise ToolError(args, 'timed out after {}s'.format(timeout))
+            except BaseException:  # including cancellation
+                Runner._kill(child)
+                await child.wait()
+                raise
+        if check and child.returncode != 0:
+            raise ToolError(args, 'exited with code {}'.format(
+                    child.returncode))
+        return subprocess.CompletedProcess(args, child.returncode,
+                output if capture else None)
+
+    @staticmethod
+    def _kill(child):
+        if child.returncode is None:
+            try:
+                child.kill()
+            except ProcessLookupError:
+                pass
+
+    @staticmethod
+    async def _communicate(child, input, on_line, on_data):
+        async def write():
+            try:
+                child.stdin.write(input)
+                await child.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # it stopped reading, which it may
+            finally:
+                child.stdin.close()
+
+        writer = None
+        if input is not None:
+            writer = asyncio.ensure_future(write())
+        output = None
+        try:
+            if on_line is not None:
+                encoding = sys.getdefaultencoding()
+                done = False
+                while True:
+                    line = await child.stdout.readline()
+                    if not line:
+                        break
+                    if not done:
+                        done = bool(on_line(line.decode(encoding)))
+                    # otherwise keep reading, so it doesn't block on writes
+            elif on_data is not None:
+                done = False
+                while True:
+                    block = await child.stdout.read(READ_BLOCK_SIZE)
+                    if not block:
+                        break
+                    if not done:
+                        done = bool(on_data(block))
+            elif child.stdout is not None:
+                output = await child.stdout.read()
+            if writer is not None:
+                await writer
+        finally:
+            if writer is not None and not writer.done():
+                writer.cancel()
+        await child.wait()
+        return output
+
+    # Runs the coroutines (of run_async calls, say) together, returning their
+    # results in order.  The first failure cancels the rest, killing their
+    # tools, and is raised.
+    @staticmethod
+    async def gather(coroutines):
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        if not tasks:
+            return []
+        done, pending = await asyncio.wait(tasks,
+                return_when=asyncio.FIRST_EXCEPTION)
+        if pending:
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+        for task in tasks:
+            if task in done and not task.cancelled() and task.exception():
+                raise task.exception()
+        return [task.result() for task in tasks]
+
+    # run_async from an ordinary thread, blocking until it's done.
+    def run(self, args, **kwargs):
+        future = asyncio.run_coroutine_threadsafe(
+                self.run_async(args, **kwargs), self._event_loop())
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()  # interrupted, so don't leave the tool running
+            raise
+
+    # run_async for each of the argument lists at once (subject to the
+    # limits), with the same keyword arguments, cancelling the rest on the
+    # first failure.  Returns the CompletedProcesses in order.
+    def run_all(self, commands, **kwargs):
+        future = asyncio.run_coroutine_threadsafe(Runner.gather(
+                [self.run_async(args, **kwargs) for args in commands]),
+                self._event_loop())
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+_runner = None
+_runner_lock = threading.Lock()
+
+def configure(jobs = None, limits = None):
+    global _runner
+    with _runner_lock:
+        _runner = Runner(jobs, limits)
+
+def active():
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = Runner()
+        return _runner
+
+def run(args, **kwargs):
+    return active().run(args, **kwargs)
+
+def run_all(commands, **kwargs):
+    return active().run_all(commands, **kwargs)
+
+# Parses TOOL=N, for command line options.
+def parse_limit(text):
+    tool, separator, limit = text.partition('=')
+    if not separator or not tool or not limit.isdigit() or int(limit) < 1:
+        raise ValueError('Expected TOOL=N: {}'.format(text))
+    return (tool, int(limit))
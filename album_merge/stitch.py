@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+import hashlib
+import mmap
+import struct
+import subprocess
+
+import flac
+
+# Joins the frames of FLAC streams that share a sample rate, channel count
+# and bit depth into a single stream, without decoding or re-encoding.
+#
+# Each stream's frames are numbered from zero, and only the final frame of a
+# fixed-blocksize stream may be short, so the output always uses the
+# variable-blocksize strategy where every frame header carries its first
+# sample number.  Only the headers change; the subframes are copied as-is.
+
+FIXED_SYNC = b'\xFF\xF8'
+VARIABLE_SYNC = b'\xFF\xF9'
+
+PLACEHOLDER_SEEKPOINT = 0xFFFFFFFFFFFFFFFF
+VENDOR = b'album_merge'
+
+def crc_table(polynomial, bits):
+    top = 1 << (bits - 1)
+    mask = (1 << bits) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (bits - 8)
+        for i in range(8):
+            crc = ((crc << 1) ^ polynomial) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+CRC8_TABLE = crc_table(0x07, 8)
+CRC16_TABLE = crc_table(0x8005, 16)
+CRC16_POLYNOMIAL = 0x18005
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+def crc16(data, crc = 0):
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+# a * b mod the CRC-16 polynomial, over GF(2)
+def crc16_multiply(a, b):
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= CRC16_POLYNOMIAL
+    return result
+
+# x^(8 * 2^k) mod the polynomial, for shifting by power-of-two byte counts
+CRC16_SHIFTS = [1 << 8]
+for i in range(40):
+    CRC16_SHIFTS.append(crc16_multiply(CRC16_SHIFTS[-1], CRC16_SHIFTS[-1]))
+
+# The CRC-16 of (data followed by length more bytes) is this applied to the
+# CRC of data, XOR the CRC of those bytes.  FLAC's CRC has a zero initial
+# value and no final XOR, so it is linear in this way; this is what lets a
+# frame's CRC be corrected for a new header without reading the subframes.
+def crc16_shift(crc, length):
+    k = 0
+    while length:
+        if length & 1:
+            crc = crc16_multiply(crc, CRC16_SHIFTS[k])
+        length >>= 1
+        k += 1
+    return crc
+
+# FLAC's extended UTF-8 coding of frame/sample numbers (up to 36 bits)
+def utf8_encode(value):
+    if value < 0x80:
+        return bytes([value])
+    for length in range(2, 8):
+        if value < (1 << (5 * length + 1)) or length == 7:
+            break
+    tail = []
+    for i in range(length - 1):
+        tail.insert(0, 0x80 | (value & 0x3F))
+        value >>= 6
+    lead = (0xFF00 >> length) & 0xFF
+    return bytes([lead | value] + tail)
+
+def utf8_decode(data, offset):
+    lead = data[offset]
+    if lead < 0x80:
+        return (lead, 1)
+    length = 2
+    while length < 8 and lead & (0x80 >> length):
+        length += 1
+    if length == 8 or not lead & 0x40:
+        raise ValueError('Invalid UTF-8 coded number.')
+    value = lead & (0x7F >> length)
+    for byte in data[offset + 1:offset + length]:
+        if byte & 0xC0 != 0x80:
+            raise ValueError('Invalid UTF-8 coded number.')
+        value = (value << 6) | (byte & 0x3F)
+    return (value, length)
+
+def block_size_from_code(code, data, offset):
+    if code == 1:
+        return (192, 0)
+    if 2 <= code <= 5:
+        return (576 << (code - 2), 0)
+    if code == 6:
+        return (data[offset] + 1, 1)
+    if code == 7:
+        return (int.from_bytes(data[offset:offset + 2], 'big') + 1, 2)
+    if code >= 8:
+        return (256 << (code - 8), 0)
+    raise ValueError('Reserved block size.')
+
+class FrameHeader(object):
+    def __init__(self, raw, variable, number, block_size, fields, extra):
+        self.raw = raw  # the original header, including its CRC-8
+        self.length = len(raw)
+        self.variable = variable
+        self.number = number  # frame number if fixed, else sample number
+        self.block_size = block_size
+        self.fields = fields  # bytes 2 and 3: sizes, rate, channels, depth
+        self.extra = extra  # explicit block size/sample rate bytes
+
+    # A variable-blocksize header starting at sample_number.
+    def rewrite(self, sample_number):
+        header = (VARIABLE_SYNC + self.fields + utf8_encode(sample_number) +
+                self.extra)
+        return header + bytes([crc8(header)])
+
+    # Returns None unless a frame header with a valid CRC-8 is at offset.
+    @staticmethod
+    def parse(data, offset):
+        if data[offset:offset + 2] not in [FIXED_SYNC, VARIABLE_SYNC]:
+            return None
+        try:
+            fields = data[offset + 2:offset + 4]
+            if len(fields) != 2 or fields[1] & 0x01:
+                return None
+            number, number_length = utf8_decode(data, offset + 4)
+            position = offset + 4 + number_length
+            block_size, size_length = block_size_from_code(fields[0] >> 4,
+                    data, position)
+            rate_code = fields[0] & 0x0F
+            rate_length = {12: 1, 13: 2, 14: 2, 15: None}.get(rate_code, 0)
+            if rate_length is None:
+                return None
+            extra = bytes(data[position:position + size_length + rate_length])
+            position += size_length + rate_length
+            if position >= len(data) or crc8(data[offset:position]) != (
+                    data[position]):
+                return None
+        except (ValueError, IndexError):
+            return None
+        return FrameHeader(bytes(data[offset:position + 1]),
+                data[offset + 1] == VARIABLE_SYNC[1], number, block_size,
+                bytes(fields), extra)
+
+# Yields (offset, length, header) for each frame of a FLAC stream in data.
+# Frames have no length field, so each one ends where the next header, with
+# the expected frame/sample number, begins.
+def stream_frames(data, info):
+    offset = info.audio_offset
+    header = FrameHeader.parse(data, offset)
+    if header is None:
+        raise ValueError('No frame header where the audio should begin.')
+    sync = VARIABLE_SYNC if header.variable else FIXED_SYNC
+    samples = 0
+    while True:
+        if header.variable:
+            expected = header.number + header.block_size
+        else:
+            expected = header.number + 1
+        following = None
+        candidate = offset + header.length
+        while following is None:
+            candidate = data.find(sync, candidate)
+            if candidate == -1:
+                break
+            following = FrameHeader.parse(data, candidate)
+            if following is not None and following.number != expected:
+                following = None
+            if following is None:
+                candidate += 1
+        if following is None:
+            end = len(data)
+            # there's no next header to confirm where this one ends, so check
+            # it in full in case something (like a tag) follows the audio
+            if crc16(data[offset:end - 2]) != int.from_bytes(
+                    data[end - 2:end], 'big'):
+                raise ValueError('Data following the last frame.')
+        else:
+            end = candidate
+        yield (offset, end - offset, header)
+        samples += header.block_size
+        if following is None:
+            break
+        offset, header = candidate, following
+    if samples != info.total_samples:
+        raise ValueError('Found {} samples, expected {}.'.format(
+                samples, info.total_samples))
+
+# Returns the MD5 of the decoded audio of the files, as stored in
+# STREAMINFO: interleaved, signed little-endian samples.
+# NOTE: requires flac
+def pcm_md5(filenames):
+    md5 = hashlib.md5()
+    for filename in filenames:
+        decoder = subprocess.Popen(['flac', '--decode', '--stdout',
+                '--silent', '--force-raw-format', '--endian=little',
+                '--sign=signed', filename], stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE)
+        while True:
+            block = decoder.stdout.read(1024 * 1024)
+            if not block:
+                break
+            md5.update(block)
+        decoder.stdout.close()
+        if decoder.wait() != 0:
+            raise RuntimeError('Error decoding ' + filename)
+    return md5.digest()
+
+class StreamInfo(object):
+    def __init__(self, sample_rate, channels, bits_per_sample, total_samples,
+            audio_offset):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+        self.total_samples = total_samples
+        self.audio_offset = audio_offset  # of the first frame
+
+    def format(self):
+        return (self.sample_rate, self.channels, self.bits_per_sample)
+
+    @staticmethod
+    def from_file(filename):
+        meta = flac.FLACMeta.from_native(filename)
+        with open(filename, 'rb') as handle:
+            for block in flac.metadata_blocks(handle):
+                pass
+        return StreamInfo(meta.sample_rate, meta.channels,
+                meta.bits_per_sample, meta.total_samples,
+                block.offset + block.length)
+
+# Writes the frames of each appended stream to a new FLAC file, then the
+# STREAMINFO and a SEEKTABLE with a point at the frame containing each of
+# the requested seekpoints (sample numbers).
+#
+# output may instead be a writable non-seekable handle (such as a pipe to a
+# muxer), in which case the metadata is written up front from what is known
+# beforehand: total_samples and max_block_size, with the frame sizes and MD5
+# left as unknown and no SEEKTABLE.
+class Stitcher(object):
+    def __init__(self, output, sample_rate, channels, bits_per_sample,
+            seekpoints = None, total_samples = 0, max_block_size = 0):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+        self.total_samples = 0
+        self.min_block_size = None
+        self.max_block_size = 0
+        self.last_block_size = None
+        self.min_frame_size = None
+        self.max_frame_size = 0
+        self._streaming = not isinstance(output, str)
+        if self._streaming:
+            self._handle = output
+            self._pending_seekpoints = []
+            # only to be written once, so state what will be true at the end
+            self.total_samples = total_samples
+            self.min_block_size = 16  # the smallest allowed
+            self.max_block_size = max_block_size
+        else:
+            self._handle = open(output, 'wb')
+            self._pending_seekpoints = sorted(set(seekpoints or []))
+        self._seekpoint_count = len(self._pending_seekpoints)
+        self._seektable = []
+        # in streaming mode this is final, otherwise it reserves space for
+        # the metadata, which is filled in by finish()
+        self._handle.write(self.metadata(bytes(16)))
+        if self._streaming:
+            self.total_samples = 0
+            self.min_block_size = None
+            self.max_block_size = 0
+        self._position = 0  # of the next frame, relative to the first
+
+    def metadata(self, md5):
+        min_block_size = self.min_block_size
+        if min_block_size is None or min_block_size > self.max_block_size:
+            min_block_size = self.max_block_size  # only one frame
+        streaminfo = (struct.pack('>HH', min_block_size or 16,
+                self.max_block_size or 16) +
+                (self.min_frame_size or 0).to_bytes(3, 'big') +
+                self.max_frame_size.to_bytes(3, 'big') +
+                ((self.sample_rate << 44) | ((self.channels - 1) << 41) |
+                        ((self.bits_per_sample - 1) << 36) |
+                        self.total_samples).to_bytes(8, 'big') + md5)
+        seektable = b''.join(struct.pack('>QQH', *point)
+                for point in self._seektable)
+        seektable += struct.pack('>QQH', PLACEHOLDER_SEEKPOINT, 0, 0) * (
+                self._seekpoint_count - len(self._seektable))
+        comment = struct.pack('<I', len(VENDOR)) + VENDOR + struct.pack(
+                '<I', 0)
+        blocks = [(flac.BlockType.STREAMINFO, streaminfo),
+                (flac.BlockType.SEEKTABLE, seektable),
+                (flac.BlockType.VORBIS_COMMENT, comment)]
+        if not self._seekpoint_count:
+            del blocks[1]
+        data = flac.FLAC_MARKER
+        for index, (block_type, block) in enumerate(blocks):
+            last = 0x80 if index == len(blocks) - 1 else 0
+            data += bytes([last | block_type]) + len(block).to_bytes(
+                    3, 'big') + block
+        return data
+
+    def append_frame(self, header, body, crc):
+        frame_start = self._position
+        new_header = header.rewrite(self.total_samples)
+        # correct the CRC-16 for the new header; body is the frame between
+        # the header and its CRC
+        crc ^= crc16_shift(crc16(header.raw) ^ crc16(new_header), len(body))
+        self._handle.write(new_header)
+        self._handle.write(body)
+        self._handle.write(crc.to_bytes(2, 'big'))
+
+        size = len(new_header) + len(body) + 2
+        self._position += size
+        self.min_frame_size = min(self.min_frame_size or size, size)
+        self.max_frame_size = max(self.max_frame_size, size)
+        # the last frame of the whole stream is exempt from the minimum
+        if self.last_block_size is not None:
+            self.min_block_size = min(self.min_block_size or
+                    self.last_block_size, self.last_block_size)
+        self.last_block_size = header.block_size
+        self.max_block_size = max(self.max_block_size, header.block_size)
+
+        end = self.total_samples + header.block_size
+        while (self._pending_seekpoints and
+                self._pending_seekpoints[0] < end):
+            self._pending_seekpoints.pop(0)
+            point = (self.total_samples, frame_start, header.block_size)
+            if not self._seektable or self._seektable[-1] != point:
+                self._seektable.append(point)
+        self.total_samples = end
+
+    def append_file(self, filename):
+        info = StreamInfo.from_file(filename)
+        if info.format() != (self.sample_rate, self.channels,
+                self.bits_per_sample):
+            raise ValueError('Mismatched format: ' + filename)
+        with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0,
+                access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                for offset, length, header in stream_frames(data, info):
+                    end = offset + length - 2
+                    self.append_frame(header,
+                            view[offset + header.length:end],
+                            int.from_bytes(data[end:end + 2], 'big'))
+            finally:
+                view.release()
+
+    # Closes the output if it was opened here; a handle is left open.
+    def finish(self, md5 = None):
+        if self._streaming:
+            self._handle.flush()
+            return
+        self._handle.seek(0)
+        self._handle.write(self.metadata(md5 or bytes(16)))
+        self._handle.close()
+
+def max_block_size(filename):
+    with open(filename, 'rb') as handle:
+        flac.skip_to_metadata(handle)
+        handle.seek(4 + 2, 1)  # STREAMINFO header, min block size
+        return int.from_bytes(flac.read_exact(handle, 2), 'big')
+
+def can_stitch(metas):
+    formats = set((meta.sample_rate, meta.channels, meta.bits_per_sample)
+            for meta in metas)
+    return len(formats) == 1 and None not in next(iter(formats))
+
+# Reads every frame of the files without writing anything, raising the
+# ValueError that merging them would.
+def check_files(filenames):
+    formats = set()
+    for filename in filenames:
+        info = StreamInfo.from_file(filename)
+        formats.add(info.format())
+        if len(formats) > 1:
+            raise ValueError('Mismatched format: ' + filename)
+        with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0,
+                access=mmap.ACCESS_READ) as data:
+            for frame in stream_frames(data, info):
+                pass
+
+# Merges the FLAC files into output (a filename, or a handle to stream to;
+# see Stitcher) without re-encoding.  The MD5 of the merged audio requires
+# decoding, which is skipped if md5 is False or when streaming.  A streamed
+# output can't be rewound once frames are written, so then every file is
+# checked first, and a ValueError means nothing was written.
+def merge_files(filenames, output, seekpoints = None, md5 = True):
+    if not isinstance(output, str):
+        check_files(filenames)
+    infos = [StreamInfo.from_file(filename) for filename in filenames]
+    first = infos[0]
+    stitcher = Stitcher(output, first.sample_rate, first.channels,
+            first.bits_per_sample, seekpoints,
+            sum(info.total_samples for info in infos),
+            max(max_block_size(filename) for filename in filenames))
+    try:
+        for filename in filenames:
+            stitcher.append_file(filename)
+    except Exception:
+        stitcher.finish()
+        raise
+    md5 = md5 and isinstance(output, str)
+    stitcher.finish(pcm_md5(filenames) if md5 else None)
+    return stitcher
@@ -2,9 +2,13 @@
 
 import os
 import sys
-import subprocess
+import mmap
+import time
+import hashlib
 
 import util
+import cache
+import runner
 import timestamp
 
 # reads lines from a file, and if the file is opened in binary mode, decodes
@@ -26,7 +30,7 @@ def line_reader(handle, terminate = False, encoding = None):
 
 def block_reader(handle, terminate = False):
     while True:
-        block = input_file.read(4096)
+        block = handle.read(4096)
         if not block:
             if terminate:
                 yield None
@@ -34,54 +38,393 @@ def block_reader(handle, terminate = False):
         yield block
 
 
+ID3V2_MARKER = b'ID3'
+
+# Returns the total length of the ID3v2 tag at the start of data (which must
+# hold at least 10 bytes), or 0 if there isn't one.
+def id3v2_length(data):
+    if len(data) < 10 or data[:3] != ID3V2_MARKER:
+        return 0
+    # syncsafe integer, 7 bits per byte
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    if data[5] & 0x10:  # footer present
+        size += 10
+    return 10 + size
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# for argument_chunks; ARG_MAX_MARGIN leaves room for whatever the exec call
+# needs besides the strings and their pointers
+DEFAULT_ARG_MAX = 128 * 1024
+ARG_MAX_MARGIN = 4096
+ARG_POINTER_SIZE = 8
+
+# yields blocks of at most block_size bytes from the current position of the
+# handle, stopping after length bytes have been read.
+def range_reader(handle, length, block_size = COPY_BLOCK_SIZE):
+    while length > 0:
+        block = handle.read(min(length, block_size))
+        if not block:
+            raise ValueError('Unexpected end of file.')
+        length -= len(block)
+        yield block
+
+# Copies length bytes at offset in src_fd to the current position of dst_fd,
+# in the kernel where possible: copy_file_range, then sendfile (for
+# filesystems/kernels that lack the former), then plain reads and writes.
+def copy_range(src_fd, dst_fd, offset, length):
+    while length > 0:
+        copied = 0
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, length, offset)
+        except (AttributeError, OSError):
+            try:
+                copied = os.sendfile(dst_fd, src_fd, offset, length)
+            except (AttributeError, OSError):
+                block = os.pread(src_fd, min(length, COPY_BLOCK_SIZE), offset)
+                if block:
+                    copied = os.write(dst_fd, block)
+        if copied == 0:
+            raise ValueError('Unexpected end of file.')
+        offset += copied
+        length -= copied
+
+# Concatenates the files into output, which is either a filename or a
+# writable handle (such as a pipe), using copy_range after preallocating the
+# output where possible.  Calls progress(index, filename, byte_offset) as
+# each file is appended, and returns the byte offset at which each file
+# begins in the output.
+def concatenate_files(filenames, output, progress = None):
+    sizes = [os.path.getsize(filename) for filename in filenames]
+    offsets = []
+    if isinstance(output, str):
+        output_file = open(output, 'wb')
+        try:
+            if sum(sizes):
+                os.posix_fallocate(output_file.fileno(), 0, sum(sizes))
+        except (AttributeError, OSError):
+            pass  # just an optimization
+    else:
+        output_file = output
+        output_file.flush()  # nothing buffered may follow what's copied
+    try:
+        fd = output_file.fileno()
+        offset = 0
+        for index, (filename, size) in enumerate(zip(filenames, sizes)):
+            if progress is not None:
+                progress(index, filename, offset)
+            offsets.append(offset)
+            with open(filename, 'rb') as input_file:
+                copy_range(input_file.fileno(), fd, 0, size)
+            offset += size
+        if output_file is not output:
+            # in case a file shrank since its size was taken
+            output_file.truncate(offset)
+    finally:
+        if output_file is not output:
+            output_file.close()
+    return offsets
+
+# A reference to a span of bytes within a file, so large payloads (such as
+# embedded pictures) needn't be held in memory until they are written out.
+class FileRange(object):
+    def __init__(self, filename, offset, length):
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+
+    def blocks(self, block_size = COPY_BLOCK_SIZE):
+        with open(self.filename, 'rb') as handle:
+            handle.seek(self.offset)
+            yield from range_reader(handle, self.length, block_size)
+
+    def read(self):
+        return b''.join(self.blocks())
+
+    # up to length bytes from offset within the range
+    def read_at(self, offset, length):
+        with open(self.filename, 'rb') as handle:
+            handle.seek(self.offset + offset)
+            return handle.read(max(0, min(length, self.length - offset)))
+
+    def write_to(self, filename):
+        with open(self.filename, 'rb') as input_file, open(
+                filename, 'wb') as output_file:
+            copy_range(input_file.fileno(), output_file.fileno(),
+                    self.offset, self.length)
+
+# A FileRange for where data appears in the file, or None if it doesn't.
+def locate_range(filename, data):
+    with open(filename, 'rb') as handle:
+        try:
+            mapped = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:  # empty
+            return None
+        with mapped:
+            offset = mapped.find(data)
+    if offset == -1:
+        return None
+    return FileRange(filename, offset, len(data))
+
+# The same interface as FileRange, for data that is already in memory.
+class BufferRange(object):
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+
+    def blocks(self, block_size = COPY_BLOCK_SIZE):
+        yield self.data
+
+    def read(self):
+        return self.data
+
+    def read_at(self, offset, length):
+        return self.data[offset:offset + length]
+
+    def write_to(self, filename):
+        write_file(filename, self.data)
+
+# Measures elapsed wall-clock time and the CPU time of this process and its
+# (waited for) children, such as encoders.
+class Stopwatch(object):
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self.cpu = Stopwatch.cpu_time()
+
+    @staticmethod
+    def cpu_time():
+        times = os.times()
+        return (times.user + times.system + times.children_user +
+                times.children_system)
+
+    def summary(self, label):
+        wall = time.perf_counter() - self.wall
+        cpu = Stopwatch.cpu_time() - self.cpu
+        return '{}: {:.1f}s wall-clock, {:.1f}s CPU ({:.1f}x)'.format(
+                label, wall, cpu, cpu / wall if wall else 0)
+
+# Returns a read-only memoryview over the mapped contents of the open
+# handle, or None if it can't be mapped (it's empty, or not a regular file).
+# The mapping outlives the handle, for as long as the view is referenced.
+def map_handle(handle):
+    try:
+        mapped = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return None
+    return memoryview(mapped)
+
+# Reads the whole file with a single readinto, into a buffer sized up front.
 def read_file(filename):
     with open(filename, 'rb') as handle:
-        data = bytearray()
+        data = bytearray(os.fstat(handle.fileno()).st_size)
+        length = handle.readinto(data)
+        if length < len(data):  # shrank since its size was taken
+            del data[length:]
+        # or grew
         for block in block_reader(handle):
             data += block
     return data
 
+# The contents of the file as a read-only memoryview, mapped rather than
+# copied where possible.  Anything taking bytes-like objects (hashlib,
+# write_file, handle.write) accepts it as-is.
+def load_file(filename):
+    with open(filename, 'rb') as handle:
+        view = map_handle(handle)
+    if view is None:
+        view = memoryview(read_file(filename)).toreadonly()
+    return view
+
+# The SHA-1 of length bytes at offset in the open handle, hashed straight
+# from the page cache where the file can be mapped.  Leaves the position of
+# the handle after the range, as reading it would.
+def range_digest(handle, offset, length):
+    digest = hashlib.sha1()
+    try:
+        mapped = mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        mapped = None
+    if mapped is not None and offset + length <= len(mapped):
+        with mapped, memoryview(mapped) as view, view[
+                offset:offset + length] as data:
+            digest.update(data)
+        handle.seek(offset + length)
+    else:
+        if mapped is not None:
+            mapped.close()
+        handle.seek(offset)
+        for block in range_reader(handle, length):
+            digest.update(block)
+    return digest
+
 def write_file(filename, data):
     with open(filename, 'wb') as output_file:
         output_file.write(data)
 
+# Splits arguments into lists that fit on a command line after the fixed
+# ones, within ARG_MAX (which also has to hold the environment) or the given
+# limit in bytes.  Every list holds at least one argument.
+def argument_chunks(fixed, arguments, limit = None):
+    # each string is NUL terminated, with a pointer to it in argv/envp
+    def cost(text):
+        return len(os.fsencode(text)) + 1 + ARG_POINTER_SIZE
+    if limit is None:
+        try:
+            limit = os.sysconf('SC_ARG_MAX')
+        except (AttributeError, ValueError, OSError):
+            limit = DEFAULT_ARG_MAX
+        limit -= sum(cost(key + '=' + value)
+                for key, value in os.environ.items()) + ARG_MAX_MARGIN
+    limit -= sum(cost(argument) for argument in fixed)
+    chunk = []
+    used = 0
+    for argument in arguments:
+        size = cost(argument)
+        if chunk and used + size > limit:
+            yield chunk
+            chunk = []
+            used = 0
+        chunk.append(argument)
+        used += size
+    if chunk:
+        yield chunk
+
+# Parses sox --info output, which describes each file in turn starting with
+# its 'Input File', into a dict for each of them.
+class SoxInfoParser(object):
+    def __init__(self):
+        self.files = []  # (input file, info)
+        self._info = None
+
+    def process_line(self, line):
+        colon = line.find(':')
+        if colon == -1:
+            return False
+        key = line[:colon].strip()
+        value = line[colon+1:].strip()
+        if value.startswith("'") and value.endswith("'"):
+            value = value[1:-1]
+        if key == 'Input File':
+            self._info = {}
+            self.files.append((value, self._info))
+            return False
+        if key == 'Comments' or key.startswith('Total Duration'):
+            # not handling tags here, and the totals follow every file
+            self._info = None
+        if self._info is None:
+            return False
+        info = self._info
+        if key == 'Channels' or key == 'Sample Rate':
+            info[key] = int(value)
+        elif key == 'Duration':
+            split_value = value.split(' = ')
+            for part in split_value:
+                split_part = part.split(' ', 1)
+                if len(split_part) == 1:
+                    info['Duration'] = timestamp.Timestamp(split_part[0])
+                elif len(split_part) == 2:
+                    if split_part[1] == 'samples':
+                        info['Total Samples'] = int(split_part[0])
+                    elif split_part[1] == 'CDDA sectors':
+                        info['CDDA Sectors'] = float(split_part[0])
+        elif key == 'Precision':
+            info['Bit Precision'] = int(value.split('-', 1)[0])
+        elif key == 'Bit Rate':
+            # in kbps; sox switches to M past 999k
+            scale = SOX_BIT_RATE_SCALES.get(value[-1:])
+            try:
+                info[key] = int(round(float(value[:-1]) * scale))
+            except (TypeError, ValueError):
+                raise RuntimeError(
+                        'Unknown format for "Bit Rate": {}'.format(value))
+        elif key != 'File Size':
+            info[key] = value
+        return False
+
+SOX_BIT_RATE_SCALES = { 'k': 1, 'M': 1000 }
+
 def sox_info(filename):
+    return cache.cached('sox_info', filename, lambda: probe_sox_info(filename))
+
+# sox_info for each of the files, in order, probing those that aren't cached
+# with as few sox processes as the command line allows.
+def sox_info_all(filenames):
+    return cache.cached_many('sox_info', filenames, probe_sox_info_all)
+
+def probe_sox_info(filename):
     # sox has a bug where --info won't let you specify type, so you can't
     # have it read from stdin
-    info = {}
-    child = subprocess.Popen(['sox', '--info', filename],
-        stdout = subprocess.PIPE)
-    for line in line_reader(child.stdout):
-        colon = line.find(':')
-        if colon != -1:
-            key = line[:colon].strip()
-            value = line[colon+1:].strip()
-            if value.startswith("'") and value.endswith("'"):
-                value = value[1:-1]
-            if key == 'Channels' or key == 'Sample Rate':
-                info[key] = int(value)
-            elif key == 'Duration':
-                split_value = value.split(' = ')
-                for part in split_value:
-                    split_part = part.split(' ', 1)
-                    if len(split_part) == 1:
-                        info['Duration'] = timestamp.Timestamp(split_part[0])
-                    elif len(split_part) == 2:
-                        if split_part[1] == 'samples':
-                            info['Total Samples'] = int(split_part[0])
-                        elif split_part[1] == 'CDDA sectors':
-                            info['CDDA Sectors'] = float(split_part[0])
-            elif key == 'Precision':
-                info['Bit Precision'] = int(value.split('-', 1)[0])
-            elif key == 'Bit Rate':
-                split_value = value.split('k', 1)
-                if len(split_value) != 2 or split_value[1] != '':
-                    raise RuntimeError(
-                            'Unknown format for "Bit Rate": {}'.format(value))
-                info[key] = int(split_value[0])
-            elif key != 'Input File' and key != 'File Size':
-                info[key] = value;
-            elif key == 'Comments':
-                break;  # not handling tags here
-    child.wait()
-    return info;
+    parser = SoxInfoParser()
+    runner.run(['sox', '--info', filename], on_line=parser.process_line,
+            timeout=runner.PROBE_TIMEOUT, check=False)
+    return parser.files[0][1] if parser.files else {}
+
+def probe_sox_info_all(filenames):
+    results = []
+    command = ['sox', '--info']
+    for chunk in argument_chunks(command, filenames):
+        parser = SoxInfoParser()
+        runner.run(command + chunk, on_line=parser.process_line,
+                timeout=runner.PROBE_TIMEOUT * len(chunk), check=False)
+        # sox reports an error for a file it can't read and moves on to the
+        # next, so match up the files it did describe
+        position = 0
+        for filename in chunk:
+            if (position < len(parser.files) and
+                    parser.files[position][0] == filename):
+                results.append(parser.files[position][1])
+                position += 1
+            else:
+                results.append(probe_sox_info(filename))
+    return results
+
+BENCHMARK_BYTES = 50 * 1024 * 1024
+
+# Times loading and hashing a file (by default, a synthetic 50 MiB one) with
+# the old appended 4 KiB blocks, read_file and load_file.
+def benchmark_loading(filename = None, repeat = 3):
+    import tempfile
+    import timeit
+    temp_name = None
+    if filename is None:
+        tfile = tempfile.mkstemp(suffix='.bin')
+        with os.fdopen(tfile[0], 'wb') as handle:
+            handle.write(os.urandom(BENCHMARK_BYTES))
+        filename = temp_name = tfile[1]
+    try:
+        def blocks():
+            data = bytearray()
+            with open(filename, 'rb') as handle:
+                for block in block_reader(handle):
+                    data += block
+            return data
+
+        size = os.path.getsize(filename)
+        expected = hashlib.sha1(blocks()).digest()
+        for name, function in [('block_reader', blocks),
+                ('read_file', lambda: read_file(filename)),
+                ('load_file', lambda: load_file(filename))]:
+            if hashlib.sha1(function()).digest() != expected:
+                raise RuntimeError('{} read different data.'.format(name))
+            best = min(timeit.repeat(
+                    lambda: hashlib.sha1(function()).digest(),
+                    number=1, repeat=repeat))
+            print('{}: {:.1f} ms to load and hash {:.1f} MiB'.format(
+                    name, best * 1000, size / (1024 * 1024)))
+    finally:
+        if temp_name is not None:
+            os.remove(temp_name)
+    return 0
+
+# A benchmark of the file loading functions:
+#   ./util.py --benchmark [file]
+def main():
+    if sys.argv[1:2] == ['--benchmark'] and len(sys.argv) <= 3:
+        return benchmark_loading(*sys.argv[2:])
+    print('Usage: {} --benchmark [file]'.format(sys.argv[0]), file=sys.stderr)
+    return 1
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+# Reads the duration of an audio file from its headers, without decoding it:
+# FLAC STREAMINFO, MP4 mvhd/mdhd and MP3 Xing/Info/VBRI frames (or, for MP3
+# without one, the frame headers themselves).  Each probe returns None when
+# the headers are missing or can't be trusted, in which case the caller has
+# to decode the file instead.
+#
+# The MP3 tables and the frame header, Xing/VBRI/LAME and ID3v2 parsing mirror
+# album_merge/mp3.py and album_merge/util.py, kept separate so that this file
+# still runs under Python 2.  A fix to either copy belongs in both.
+
+import os
+import struct
+
+# kbps, indexed by [version is MPEG1][layer][bitrate index]
+MP3_BIT_RATES = {
+  True: {
+    1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+  },
+  False: {
+    1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+  },
+}
+
+# indexed by the version bits: MPEG2.5, reserved, MPEG2, MPEG1
+MP3_SAMPLE_RATES = [[11025, 12000, 8000], None, [22050, 24000, 16000],
+    [44100, 48000, 32000]]
+
+# how far into the file to look for the first MP3 frame
+MP3_SYNC_WINDOW = 64 * 1024
+# a VBR header whose byte count is off by more than this isn't trusted
+MP3_BYTES_TOLERANCE = 0.02
+
+def milliseconds(samples, sample_rate):
+  return (samples * 1000 + sample_rate // 2) // sample_rate
+
+def id3v2_length(data):
+  data = bytearray(data[:10])
+  if len(data) < 10 or data[:3] != b'ID3':
+    return 0
+  size = 0
+  for byte in data[6:10]:
+    size = (size << 7) | (byte & 0x7F)
+  length = 10 + size
+  if data[5] & 0x10:  # footer
+    length += 10
+  return length
+
+#
+# FLAC
+#
+def flac_milliseconds(handle):
+  handle.seek(0)
+  handle.seek(id3v2_length(handle.read(10)))
+  data = bytearray(handle.read(4 + 4 + 18))
+  if len(data) < 26 or data[:4] != b'fLaC' or (data[4] & 0x7F) != 0:
+    return None
+  # STREAMINFO: 20 bits of sample rate, 3 channels, 5 bps, 36 total samples
+  fields = struct.unpack('>Q', bytes(data[18:26]))[0]
+  sample_rate = fields >> 44
+  total_samples = fields & ((1 << 36) - 1)
+  if not sample_rate or not total_samples:  # 0 is unknown
+    return None
+  return milliseconds(total_samples, sample_rate)
+
+#
+# MP4
+#
+def mp4_boxes(handle, start, end):
+  """ Yields (type, payload offset, payload end) for each box in [start,
+  end). """
+  offset = start
+  while offset + 8 <= end:
+    handle.seek(offset)
+    size, box_type = struct.unpack('>I4s', handle.read(8))
+    header = 8
+    if size == 1:
+      size = struct.unpack('>Q', handle.read(8))[0]
+      header = 16
+    elif size == 0:
+      size = end - offset
+    if size < header or offset + size > end:
+      return
+    yield (box_type, offset + header, offset + size)
+    offset += size
+
+def mp4_child(handle, start, end, box_type):
+  for child_type, child_start, child_end in mp4_boxes(handle, start, end):
+    if child_type == box_type:
+      return (child_start, child_end)
+  return None
+
+def mp4_header_duration(handle, start):
+  """ (timescale, duration) from a mvhd or mdhd box. """
+  handle.seek(start)
+  version = bytearray(handle.read(4))[0]
+  if version == 1:
+    handle.seek(start + 4 + 16)
+    timescale, duration = struct.unpack('>IQ', handle.read(12))
+    unknown = (1 << 64) - 1
+  else:
+    handle.seek(start + 4 + 8)
+    timescale, duration = struct.unpack('>II', handle.read(8))
+    unknown = (1 << 32) - 1
+  if not timescale or not duration or duration == unknown:
+    return None
+  return (timescale, duration)
+
+def mp4_milliseconds(handle, file_size):
+  moov = mp4_child(handle, 0, file_size, b'moov')
+  if moov is None:
+    return None
+  # fragmented files only declare the initial part in the moov
+  if mp4_child(handle, moov[0], moov[1], b'mvex') is not None:
+    return None
+  # the sound track's own duration is in its (finer) sample timescale
+  for box_type, start, end in mp4_boxes(handle, moov[0], moov[1]):
+    if box_type != b'trak':
+      continue
+    mdia = mp4_child(handle, start, end, b'mdia')
+    if mdia is None:
+      continue
+    hdlr = mp4_child(handle, mdia[0], mdia[1], b'hdlr')
+    mdhd = mp4_child(handle, mdia[0], mdia[1], b'mdhd')
+    if hdlr is None or mdhd is None:
+      continue
+    handle.seek(hdlr[0] + 8)
+    if handle.read(4) != b'soun':
+      continue
+    header = mp4_header_duration(handle, mdhd[0])
+    if header is not None:
+      return milliseconds(header[1], header[0])
+  mvhd = mp4_child(handle, moov[0], moov[1], b'mvhd')
+  if mvhd is None:
+    return None
+  header = mp4_header_duration(handle, mvhd[0])
+  if header is None:
+    return None
+  return milliseconds(header[1], header[0])
+
+#
+# MP3
+#
+class MP3Frame(object):
+  def __init__(self, mpeg1, layer, bit_rate, sample_rate, padding, mono):
+    self.mpeg1 = mpeg1
+    self.layer = layer
+    self.bit_rate = bit_rate
+    self.sample_rate = sample_rate
+    self.padding = padding
+    self.mono = mono
+
+  def samples(self):
+    if self.layer == 1:
+      return 384
+    if self.layer == 3 and not self.mpeg1:
+      return 576
+    return 1152
+
+  def length(self):
+    if self.layer == 1:
+      return (12000 * self.bit_rate // self.sample_rate + self.padding) * 4
+    return (self.samples() // 8 * 1000 * self.bit_rate // self.sample_rate +
+        self.padding)
+
+  def side_info_length(self):
+    if self.mpeg1:
+      return 17 if self.mono else 32
+    return 9 if self.mono else 17
+
+  @staticmethod
+  def parse(data, offset):
+    """ The frame header at offset, or None.  Free-format frames aren't
+    supported. """
+    if offset + 4 > len(data):
+      return None
+    b0, b1, b2, b3 = data[offset:offset + 4]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+      return None
+    version = (b1 >> 3) & 0x03
+    layer = 4 - ((b1 >> 1) & 0x03)
+    bit_rate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if (version == 1 or layer == 4 or bit_rate_index in [0, 15] or
+        sample_rate_index == 3):
+      return None
+    mpeg1 = (version == 3)
+    return MP3Frame(mpeg1, layer, MP3_BIT_RATES[mpeg1][layer][bit_rate_index],
+        MP3_SAMPLE_RATES[version][sample_rate_index], (b2 >> 1) & 0x01,
+        (b3 >> 6) == 3)
+
+def mp3_find_frame(data, offset):
+  """ The first frame header that is followed by another, to avoid syncing on
+  stray 0xFF bytes. """
+  while True:
+    offset = data.find(b'\xFF', offset)
+    if offset == -1:
+      return (None, None)
+    frame = MP3Frame.parse(data, offset)
+    if frame is not None:
+      following = MP3Frame.parse(data, offset + frame.length())
+      if following is not None and following.sample_rate == frame.sample_rate:
+        return (offset, frame)
+    offset += 1
+
+def mp3_vbr_header(data, offset, frame):
+  """ (frames, bytes or None, LAME delay + padding) from a Xing/Info or VBRI
+  header in the frame at offset, or None. """
+  xing = offset + 4 + frame.side_info_length()
+  if data[xing:xing + 4] in [b'Xing', b'Info']:
+    flags = struct.unpack('>I', bytes(data[xing + 4:xing + 8]))[0]
+    if not flags & 0x01:
+      return None
+    position = xing + 8
+    frames = struct.unpack('>I', bytes(data[position:position + 4]))[0]
+    position += 4
+    byte_count = None
+    if flags & 0x02:
+      byte_count = struct.unpack('>I', bytes(data[position:position + 4]))[0]
+      position += 4
+    if flags & 0x04:
+      position += 100  # TOC
+    if flags & 0x08:
+      position += 4  # quality
+    trimmed = 0
+    # the LAME extension records the encoder delay and padding, which ffmpeg
+    # (the fallback) trims too; album_merge's mp3.py reads the same fields,
+    # but keeps them apart from its untrimmed count
+    if data[position:position + 4] == b'LAME':
+      gapless = data[position + 21:position + 24]
+      if len(gapless) == 3:
+        trimmed = (gapless[0] << 4 | gapless[1] >> 4) + (
+            (gapless[1] & 0x0F) << 8 | gapless[2])
+    return (frames, byte_count, trimmed)
+  vbri = offset + 4 + 32
+  if data[vbri:vbri + 4] == b'VBRI':
+    byte_count, frames = struct.unpack('>II', bytes(data[vbri + 10:vbri + 18]))
+    return (frames, byte_count, 0)
+  return None
+
+def mp3_milliseconds(handle, file_size):
+  handle.seek(0)
+  start = id3v2_length(handle.read(10))
+  handle.seek(start)
+  data = bytearray(handle.read(MP3_SYNC_WINDOW))
+  offset, frame = mp3_find_frame(data, 0)
+  if frame is None:
+    return None
+  audio_bytes = file_size - start - offset
+  vbr = mp3_vbr_header(data, offset, frame)
+  if vbr is not None:
+    frames, byte_count, trimmed = vbr
+    # a header left over from before the file was edited would be wrong
+    if frames and (byte_count is None or abs(byte_count - audio_bytes) <=
+        audio_bytes * MP3_BYTES_TOLERANCE):
+      return milliseconds(max(frames * frame.samples() - trimmed, 0),
+          frame.sample_rate)
+
+  # no usable header: count the samples of every frame, reading only the
+  # frame headers
+  samples = 0
+  position = start + offset
+  if vbr is not None:
+    position += frame.length()  # not audio
+  while True:
+    handle.seek(position)
+    header = bytearray(handle.read(4))
+    current = MP3Frame.parse(header, 0)
+    if current is None or current.sample_rate != frame.sample_rate:
+      break
+    samples += current.samples()
+    position += current.length()
+  # anything but trailing tags means a frame was damaged
+  if file_size - position > 128 + 32 * 1024:
+    return None
+  return milliseconds(samples, frame.sample_rate)
+
+def audio_milliseconds(filename):
+  """ The duration of the file in milliseconds, or None if its headers
+  don't say. """
+  file_size = os.path.getsize(filename)
+  with open(filename, 'rb') as handle:
+    start = handle.read(12)
+    handle.seek(0)
+    try:
+      if start[:4] == b'fLaC' or (start[:3] == b'ID3' and
+          os.path.splitext(filename)[1].lower() == '.flac'):
+        return flac_milliseconds(handle)
+      if start[4:8] == b'ftyp':
+        return mp4_milliseconds(handle, file_size)
+      return mp3_milliseconds(handle, file_size)
+    except (struct.error, IndexError):  # truncated headers
+      return None
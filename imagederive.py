@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# Generates resized copies of images (covers, mostly) with ImageMagick,
+# decoding each source once however many sizes are asked of it, and caching
+# the results by (source digest, size, filter) so that rerunning with the
+# same source costs only a hash of it.  Least recently used results are
+# evicted once the cache exceeds max_bytes.  Used by album_merge and
+# mkv_tools.
+
+import hashlib
+import os
+import subprocess
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+HASH_BLOCK_SIZE = 1024 * 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+def default_cache_dir():
+  root = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+      os.path.expanduser('~'), '.cache')
+  return os.path.join(root, 'image_derivatives')
+
+class Derivative(object):
+  """ A requested output: an ImageMagick geometry (such as 'x600') and the
+  resize operator to apply it with. """
+  def __init__(self, geometry, resize='resize'):
+    self.geometry = geometry
+    self.resize = resize
+
+  def key(self, extension):
+    # geometry can hold characters like '>' and '!'
+    safe = ''.join(c if c.isalnum() else '_' for c in self.geometry)
+    return '%s_%s%s' % (safe, self.resize, extension)
+
+def file_digest(filename):
+  digest = hashlib.sha1()
+  with open(filename, 'rb') as handle:
+    while True:
+      block = handle.read(HASH_BLOCK_SIZE)
+      if not block:
+        break
+      digest.update(block)
+  return digest.hexdigest()
+
+def evict(cache_dir, max_bytes, keep=()):
+  """ Removes the least recently used files (by mtime, which derive
+  refreshes on every use) until the cache holds at most max_bytes, sparing
+  the paths in keep. """
+  entries = []
+  total = 0
+  for directory, subdirectories, filenames in os.walk(cache_dir):
+    for filename in filenames:
+      path = os.path.join(directory, filename)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue  # removed by a concurrent run
+      entries.append((stat.st_mtime, stat.st_size, path))
+      total += stat.st_size
+  if total <= max_bytes:
+    return
+  keep = set(keep)
+  entries.sort()
+  for mtime, size, path in entries:
+    if path in keep:
+      continue
+    try:
+      os.remove(path)
+    except OSError:
+      continue
+    total -= size
+    try:
+      os.rmdir(os.path.dirname(path))  # once it's empty
+    except OSError:
+      pass
+    if total <= max_bytes:
+      break
+
+def _derive(source, derivatives, extension, cache_dir):
+  """ derive(), without evicting anything. """
+  if extension is None:
+    extension = os.path.splitext(source)[1].lower()
+  directory = os.path.join(cache_dir, file_digest(source))
+  outputs = [os.path.join(directory, derivative.key(extension))
+      for derivative in derivatives]
+  missing = []
+  for derivative, output in zip(derivatives, outputs):
+    try:
+      os.utime(output, None)  # marks it as recently used
+    except OSError:
+      missing.append((derivative, output))
+  if not missing:
+    return outputs
+
+  if not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError:
+      if not os.path.isdir(directory):  # lost a race, otherwise
+        raise
+  # written under temporary names, then renamed into place, so a concurrent
+  # run never sees a partial file
+  temp_names = []
+  cmd = ['convert', source]
+  for derivative, output in missing:
+    tfile = tempfile.mkstemp(suffix=extension, dir=directory)
+    os.close(tfile[0])
+    temp_names.append(tfile[1])
+    cmd.extend(['(', '+clone', '-' + derivative.resize, derivative.geometry,
+        '-write', tfile[1], '+delete', ')'])
+  cmd.append('null:')
+  try:
+    # req imagemagick
+    if subprocess.call(cmd) != 0:
+      raise RuntimeError('Error resizing image: %s' % (source))
+    for temp_name, (derivative, output) in zip(temp_names, missing):
+      os.rename(temp_name, output)
+  finally:
+    for temp_name in temp_names:
+      if os.path.exists(temp_name):
+        os.remove(temp_name)
+  return outputs
+
+def derive(source, derivatives, extension=None, cache_dir=None,
+    max_bytes=DEFAULT_MAX_BYTES):
+  """ Returns the cached path of each derivative of source, generating any
+  that are missing in a single convert run.  They are in the format of
+  extension (by default, that of source).  The returned files belong to the
+  cache, so copy them rather than moving or editing them, and before deriving
+  anything else, which may evict them. """
+  if cache_dir is None:
+    cache_dir = default_cache_dir()
+  outputs = _derive(source, derivatives, extension, cache_dir)
+  evict(cache_dir, max_bytes, outputs)
+  return outputs
+
+def derive_all(requests, jobs=1, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+  """ derive() for each (source, derivatives, extension) request, running up
+  to jobs of them at once.  Returns the list of outputs of each request, in
+  order.  Nothing is evicted until every request is done, and then none of
+  the outputs are, so one request can't evict what another returned. """
+  if cache_dir is None:
+    cache_dir = default_cache_dir()
+  if jobs <= 1 or len(requests) <= 1:
+    results = [_derive(source, derivatives, extension, cache_dir)
+        for source, derivatives, extension in requests]
+  else:
+    pool = ThreadPool(min(jobs, len(requests)))
+    try:
+      results = pool.map(lambda request: _derive(request[0], request[1],
+          request[2], cache_dir), requests)
+    finally:
+      pool.close()
+  evict(cache_dir, max_bytes,
+      [output for outputs in results for output in outputs])
+  return results
@@ -1,8 +1,16 @@
 #!/usr/bin/python
 
 from pynx import *
+from multiprocessing.pool import ThreadPool
+import duration
+import imagederive
+import json
+import mkvedit
+import multiprocessing
 import os
+import sys
 import tempfile
+import xml.etree.ElementTree as ET
 
 def get_milliseconds(timestamp):
   parts=timestamp.split(':')
@@ -22,7 +30,15 @@ def get_milliseconds(timestamp):
   parts.extend(lastparts)
   return get_milliseconds_from_parts(*parts)
 
+# Reads the duration from the file's headers, only decoding the whole file
+# if they are missing or can't be trusted.
 def get_audio_milliseconds(filename):
+  milliseconds=duration.audio_milliseconds(filename)
+  if milliseconds is not None:
+    return milliseconds
+  return decode_audio_milliseconds(filename)
+
+def decode_audio_milliseconds(filename):
   cmd=[ 'ffmpeg',
       '-i', filename,
       '-vcodec', 'copy',
@@ -51,10 +67,15 @@ def get_combined_offsets(files=None):
   if files is None:
     files=os.listdir('.')
     files.sort()
+  # probed concurrently; most only need a few reads of their headers
+  pool=ThreadPool(min(len(files), multiprocessing.cpu_count() * 2) or 1)
+  try:
+    lengths=pool.map(get_audio_milliseconds, files)
+  finally:
+    pool.close()
   offset=0
   chapter_list = []
-  for filename in files:
-    length=get_audio_milliseconds(filename)
+  for filename, length in zip(files, lengths):
     chapter_list.append((get_timestamp(offset),filename))
     offset += length
   return chapter_xml(chapters_from_tuples(chapter_list))
@@ -131,20 +152,11 @@ def join_files(output,files,vlc_fix=False):
     cmd.append(filename)
   return ExecuteCommand(cmd).returnCode()
 
-def clear_tags(filename):
-  return ExecuteCommand([ 'mkvpropedit', '--tags', "global:", filename]).returnCode()
-
-def set_chapters(filename, chapters_xml_file):
-  return ExecuteCommand([
-      'mkvpropedit',
-      '--chapters', chapters_xml_file,
-      filename]).returnCode()
-
 # GENRE (Audiobooks)
 # TITLE
 # DATE_RELEASED
 # ARTIST
-def set_tags(filename,tagdict):
+def tags_xml(tagdict):
   # TODO: don't assume english
 
   tag_lines = [
@@ -162,51 +174,205 @@ def set_tags(filename,tagdict):
   tag_lines.extend([
     "  </Tag>",
     "</Tags>" ])
+  return os.linesep.join(tag_lines)
 
-  tfile=tempfile.mkstemp()
-  os.write(tfile[0],os.linesep.join(tag_lines))
-  os.close(tfile[0])
-
-  ret=ExecuteCommand([ 'mkvpropedit', '--tags', "global:"+tfile[1], filename]).returnCode()
-  os.remove(tfile[1])
-  return ret
-
-def set_cover(filename,cover_filename):
-
+def cover_extension(cover_filename):
   ext=os.path.splitext(cover_filename)[1].lower()
   if ext != ".jpg" and ext != ".jpeg" and ext != ".png":
     raise Exception("Invalid cover format!")
+  return ext
+
+# the order edits are applied in
+EDIT_KINDS = [ 'tags', 'chapters', 'cover', 'language' ]
+
+# Collects the edits to one file, then applies them together: in a single
+# pass with mkvedit, which only rewrites the edited elements, or otherwise in
+# one mkvpropedit invocation.  A later edit of the same kind replaces an
+# earlier one, so clear_tags followed by set_tags writes the tags once.
+class EditSession(object):
+  def __init__(self,filename):
+    self.filename=filename
+    self._edits={}  # kind: (description, value)
+    self._temp_files=[]
+    self.results=[]  # (description, error or None), once applied
+
+  def clear_tags(self):
+    self._edits['tags']=('clear tags', {})
+
+  def set_tags(self,tagdict):
+    self._edits['tags']=(('set %d tags') % (len(tagdict)), tagdict)
+
+  def set_chapters(self,chapters_xml_file):
+    self._edits['chapters']=('set chapters', chapters_xml_file)
+
+  def set_cover(self,cover_filename):
+    cover_extension(cover_filename)
+    self._edits['cover']=('set cover', cover_filename)
+
+  def set_audio_language(self,language="eng"):
+    self._edits['language']=(('set language %s') % (language), language)
+
+  def _temp_file(self,suffix=''):
+    tfile=tempfile.mkstemp(suffix=suffix)
+    os.close(tfile[0])
+    self._temp_files.append(tfile[1])
+    return tfile[1]
+
+  # the (big, small) covers, from one decode of the cover, and cached
+  def _cover_images(self,cover_filename):
+    cover_extension(cover_filename)
+    return imagederive.derive(cover_filename, [
+        imagederive.Derivative('x600'), imagederive.Derivative('x120') ])
+
+  # Enumerates the attachments with mkvmerge, returning a mkvpropedit
+  # selector for each: by UID, so deleting one doesn't renumber the rest.
+  def _attachment_selectors(self):
+    command=ExecuteCommand([ 'mkvmerge', '-J', self.filename ],
+        get_output=True)
+    output=command.output()[0]
+    if command.returnCode() not in [ 0, 1 ]:  # 1 is warnings
+      raise Exception(("Error identifying %s") % (self.filename))
+    selectors=[]
+    for attachment in json.loads(output).get('attachments', []):
+      uid=attachment.get('properties', {}).get('uid')
+      if uid is not None:
+        selectors.append(('=%d') % (uid))
+      else:
+        selectors.append(str(attachment['id']))
+    return selectors
+
+  def _edit_natively(self,mkv,kind,value):
+    if kind == 'tags':
+      tags=None
+      if value:
+        tags=mkvedit.tags_from_xml(ET.fromstring(tags_xml(value)))
+      mkv.replace_global_tags(tags)
+    elif kind == 'chapters':
+      chapters=mkvedit.chapters_from_xml(ET.parse(value).getroot())
+      mkv.replace(mkvedit.CHAPTERS, chapters or None)
+    elif kind == 'cover':
+      ext=cover_extension(value)
+      big_cover, small_cover=self._cover_images(value)
+      mkv.set_attached_files([
+          mkvedit.AttachedFile.from_file(small_cover, 'cover_small'+ext),
+          mkvedit.AttachedFile.from_file(big_cover, 'cover'+ext) ])
+    elif kind == 'language':
+      mkv.set_audio_language(value)
+
+  # Returns the kinds of edit left for mkvpropedit.
+  def _apply_natively(self,kinds):
+    try:
+      mkv=mkvedit.MatroskaFile(self.filename)
+    except mkvedit.EditError as e:
+      sys.stderr.write(('Using mkvpropedit for %s: %s\n') % (self.filename, e))
+      return kinds
+    left=[]
+    with mkv:
+      for kind in kinds:
+        description, value=self._edits[kind]
+        try:
+          self._edit_natively(mkv, kind, value)
+        except mkvedit.EditError as e:
+          sys.stderr.write(('Using mkvpropedit to %s: %s\n') % (description, e))
+          left.append(kind)
+        except Exception as e:
+          self.results.append((description, e))
+        else:
+          self.results.append((description, None))
+    return left
+
+  def _propedit_arguments(self,kind,value):
+    if kind == 'tags':
+      if not value:
+        return [ '--tags', 'global:' ]
+      tfile=self._temp_file('.xml')
+      with open(tfile, 'w') as handle:
+        handle.write(tags_xml(value))
+      return [ '--tags', 'global:'+tfile ]
+    elif kind == 'chapters':
+      return [ '--chapters', value ]
+    elif kind == 'cover':
+      ext=cover_extension(value)
+      big_cover, small_cover=self._cover_images(value)
+      # every existing attachment goes, in the same invocation
+      args=[]
+      for selector in self._attachment_selectors():
+        args.extend([ '--delete-attachment', selector ])
+      return args + [
+          '--attachment-name', 'cover_small'+ext,
+          '--add-attachment', small_cover,
+          '--attachment-name', 'cover'+ext,
+          '--add-attachment', big_cover ]
+    elif kind == 'language':
+      return [ '--edit', 'track:a1', '--set', ('language=%s') % (value) ]
+
+  def _apply_mkvpropedit(self,kinds):
+    cmd=[ 'mkvpropedit', self.filename ]
+    applied=[]
+    for kind in kinds:
+      description, value=self._edits[kind]
+      try:
+        cmd.extend(self._propedit_arguments(kind, value))
+      except Exception as e:
+        self.results.append((description, e))
+      else:
+        applied.append(description)
+    if not applied:
+      return
+    ret=ExecuteCommand(cmd).returnCode()
+    error=None
+    if ret != 0:
+      error=('mkvpropedit exited with code %d') % (ret)
+    for description in applied:
+      self.results.append((description, error))
+
+  # Applies every edit, printing a summary of them.  Returns 0 if they all
+  # succeeded.
+  def apply(self):
+    self.results=[]
+    kinds=[ kind for kind in EDIT_KINDS if kind in self._edits ]
+    try:
+      left=self._apply_natively(kinds)
+      if left:
+        self._apply_mkvpropedit(left)
+    finally:
+      for name in self._temp_files:
+        os.remove(name)
+      self._temp_files=[]
+      self._edits={}
+    failed=[ result for result in self.results if result[1] is not None ]
+    summary=[]
+    for description, error in self.results:
+      if error is None:
+        summary.append(description)
+      else:
+        summary.append(('%s FAILED (%s)') % (description, error))
+    print(('%s: %s') % (self.filename, '; '.join(summary) or 'no edits'))
+    if failed:
+      return 1
+    return 0
 
-  big_cover=tempfile.mkstemp()
-  os.close(big_cover[0])
-  small_cover=tempfile.mkstemp()
-  os.close(small_cover[0])
-
-  ExecuteCommand(['convert', cover_filename, '-resize', 'x600', big_cover[1]])
-  ExecuteCommand(['convert', cover_filename, '-resize', 'x120', small_cover[1]])
-
-  # TODO: make this delete all attachments then add, not replace
-  for i in range(0,50):
-    ignore=ExecuteCommand([
-        'mkvpropedit',
-        '--delete-attachment', '1',
-        filename],get_output=True).output()
-
-  ExecuteCommand([
-      'mkvpropedit',
-      '--attachment-name', 'cover_small'+ext,
-      '--add-attachment', small_cover[1],
-      filename])
+def clear_tags(filename):
+  session=EditSession(filename)
+  session.clear_tags()
+  return session.apply()
 
-  ExecuteCommand([
-      'mkvpropedit',
-      '--attachment-name', 'cover'+ext,
-      '--add-attachment', big_cover[1],
-      filename])
+def set_chapters(filename, chapters_xml_file):
+  session=EditSession(filename)
+  session.set_chapters(chapters_xml_file)
+  return session.apply()
 
+def set_tags(filename,tagdict):
+  session=EditSession(filename)
+  session.set_tags(tagdict)
+  return session.apply()
 
-  os.remove(big_cover[1])
-  os.remove(small_cover[1])
+def set_cover(filename,cover_filename):
+  session=EditSession(filename)
+  session.set_cover(cover_filename)
+  return session.apply()
 
 def set_audio_language(filename,language="eng"):
-  return ExecuteCommand(['mkvpropedit', 'filename', '--edit', 'track:a1', '--set', ('language=%s')%(language)]).returnCode()
+  session=EditSession(filename)
+  session.set_audio_language(language)
+  return session.apply()
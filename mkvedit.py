@@ -0,0 +1,580 @@
+#!/usr/bin/python
+
+# Edits the Tags, Chapters and Attachments of a Matroska file in place,
+# without mkvpropedit.  Only the edited element is written: it is put back
+# where it was (or into a Void) if it fits, padding what's left with a Void,
+# and otherwise the old one becomes a Void and the new one is appended to the
+# end of the segment, with the SeekHead updated to match.  Clusters are
+# never moved, so editing the tags of a large file writes a few KB.
+# https://www.matroska.org/technical/elements.html
+
+import mimetypes
+import os
+import random
+import struct
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+CLUSTER = 0x1F43B675
+VOID = 0xEC
+CRC32 = 0xBF
+
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_TYPE = 0x83
+TRACK_TYPE_AUDIO = 2
+LANGUAGE = 0x22B59C
+LANGUAGE_BCP47 = 0x22B59D
+TAGS = 0x1254C367
+TAG = 0x7373
+TARGETS = 0x63C0
+TAG_TRACK_UID = 0x63C5
+TAG_EDITION_UID = 0x63C9
+TAG_CHAPTER_UID = 0x63C4
+TAG_ATTACHMENT_UID = 0x63C6
+CHAPTERS = 0x1043A770
+ATTACHMENTS = 0x1941A469
+ATTACHED_FILE = 0x61A7
+FILE_DESCRIPTION = 0x467E
+FILE_NAME = 0x466E
+FILE_MIME_TYPE = 0x4660
+FILE_DATA = 0x465C
+FILE_UID = 0x46AE
+
+UNKNOWN_SIZE = -1
+
+# Value types, for converting the mkvtoolnix XML formats.
+MASTER, UINT, STRING, TIME, BINARY = range(5)
+
+# matroskatags.dtd names
+TAG_ELEMENTS = {
+  'Tags': (TAGS, MASTER),
+  'Tag': (TAG, MASTER),
+  'Targets': (TARGETS, MASTER),
+  'TargetTypeValue': (0x68CA, UINT),
+  'TargetType': (0x63CA, STRING),
+  'TrackUID': (TAG_TRACK_UID, UINT),
+  'EditionUID': (TAG_EDITION_UID, UINT),
+  'ChapterUID': (TAG_CHAPTER_UID, UINT),
+  'AttachmentUID': (TAG_ATTACHMENT_UID, UINT),
+  'Simple': (0x67C8, MASTER),
+  'Name': (0x45A3, STRING),
+  'String': (0x4487, STRING),
+  'Binary': (0x4485, BINARY),
+  'TagLanguage': (0x447A, STRING),
+  'DefaultLanguage': (0x4484, UINT),
+}
+
+# matroskachapters.dtd names
+CHAPTER_ELEMENTS = {
+  'Chapters': (CHAPTERS, MASTER),
+  'EditionEntry': (0x45B9, MASTER),
+  'EditionUID': (0x45BC, UINT),
+  'EditionFlagHidden': (0x45BD, UINT),
+  'EditionFlagDefault': (0x45DB, UINT),
+  'EditionFlagOrdered': (0x45DD, UINT),
+  'ChapterAtom': (0xB6, MASTER),
+  'ChapterUID': (0x73C4, UINT),
+  'ChapterStringUID': (0x5654, STRING),
+  'ChapterTimeStart': (0x91, TIME),
+  'ChapterTimeEnd': (0x92, TIME),
+  'ChapterFlagHidden': (0x98, UINT),
+  'ChapterFlagEnabled': (0x4598, UINT),
+  'ChapterSegmentUID': (0x6E67, BINARY),
+  'ChapterDisplay': (0x80, MASTER),
+  'ChapterString': (0x85, STRING),
+  'ChapterLanguage': (0x437C, STRING),
+  'ChapterCountry': (0x437E, STRING),
+}
+
+class EditError(Exception):
+  """ Raised when a file can't be edited natively (such as a missing
+  SeekHead, or a segment that isn't at the end of the file), in which case
+  mkvpropedit can still be used. """
+  pass
+
+#
+# EBML encoding
+#
+def encode_id(element_id):
+  data = struct.pack('>I', element_id)
+  return data[4 - (element_id.bit_length() + 7) // 8:]
+
+def encode_size(size, width=None):
+  if width is None:
+    width = 1
+    while size >= (1 << (7 * width)) - 1:
+      width += 1
+  elif size >= (1 << (7 * width)) - 1:
+    raise EditError("Size %d doesn't fit in %d bytes" % (size, width))
+  return struct.pack('>Q', (1 << (7 * width)) | size)[8 - width:]
+
+def encode_uint(value, width=None):
+  if width is None:
+    width = max(1, (value.bit_length() + 7) // 8)
+  return struct.pack('>Q', value)[8 - width:]
+
+def element(element_id, payload):
+  return encode_id(element_id) + encode_size(len(payload)) + payload
+
+def void(length):
+  """ The header of a Void element that is length bytes long in total, for
+  length >= 2. """
+  if length < 2:
+    raise EditError("No room for a Void of %d bytes" % (length))
+  if length - 2 < 127:
+    return encode_id(VOID) + encode_size(length - 2, 1)
+  return encode_id(VOID) + encode_size(length - 9, 8)
+
+# whether an element can replace space bytes, leaving room for a Void
+def fits(length, space):
+  return length == space or length + 2 <= space
+
+#
+# EBML decoding
+#
+class Element(object):
+  def __init__(self, element_id, offset, data_offset, size):
+    self.id = element_id
+    self.offset = offset
+    self.data_offset = data_offset
+    self.size = size
+
+  def end(self):
+    return self.data_offset + self.size
+
+  def length(self):
+    return self.end() - self.offset
+
+def decode_vint(data, offset, keep_marker):
+  """ Returns the value of the variable-length integer at offset, and its
+  width.  Sizes with every value bit set are UNKNOWN_SIZE. """
+  first = bytearray(data[offset:offset + 1])
+  if not first or not first[0]:
+    raise EditError('Invalid EBML integer')
+  width = 1
+  while not first[0] & (0x80 >> (width - 1)):
+    width += 1
+  raw = data[offset:offset + width]
+  if len(raw) != width:
+    raise EditError('Truncated EBML integer')
+  value = struct.unpack('>Q', b'\0' * (8 - width) + raw)[0]
+  if not keep_marker:
+    mask = (1 << (7 * width)) - 1
+    value &= mask
+    if value == mask:
+      value = UNKNOWN_SIZE
+  return (value, width)
+
+def read_element(handle, offset):
+  handle.seek(offset)
+  data = handle.read(12)  # at most a 4 byte id and an 8 byte size
+  element_id, id_width = decode_vint(data, 0, True)
+  size, size_width = decode_vint(data, id_width, False)
+  return Element(element_id, offset, offset + id_width + size_width, size)
+
+def child_elements(data):
+  """ Yields (id, payload) for each element within a master's payload. """
+  offset = 0
+  while offset < len(data):
+    element_id, width = decode_vint(data, offset, True)
+    offset += width
+    size, width = decode_vint(data, offset, False)
+    offset += width
+    if size == UNKNOWN_SIZE or offset + size > len(data):
+      raise EditError('Invalid child element size')
+    yield (element_id, data[offset:offset + size])
+    offset += size
+
+def decode_uint(data):
+  return struct.unpack('>Q', b'\0' * (8 - len(data)) + data)[0]
+
+#
+# XML conversion
+#
+def parse_time(text):
+  """ Nanoseconds from an HH:MM:SS.nnnnnnnnn timestamp. """
+  parts = text.strip().split(':')
+  seconds = parts.pop().split('.')
+  nanoseconds = int(seconds[0]) * 1000000000
+  if len(seconds) > 1:
+    nanoseconds += int(seconds[1][:9].ljust(9, '0'))
+  multiplier = 60 * 1000000000
+  for part in reversed(parts):
+    nanoseconds += int(part) * multiplier
+    multiplier *= 60
+  return nanoseconds
+
+def random_uid():
+  return random.getrandbits(64) or 1
+
+def xml_element(node, names):
+  """ Encodes an XML element (and its children) of one of the mkvtoolnix
+  formats, whose names map to (id, type). """
+  element_id, value_type = names[node.tag]
+  text = (node.text or '').strip()
+  if value_type == MASTER:
+    children = [child for child in node if isinstance(child.tag, str)]
+    payload = b''.join(xml_element(child, names) for child in children)
+    # mandatory elements without a default
+    tags = [child.tag for child in children]
+    if node.tag == 'ChapterAtom' and 'ChapterUID' not in tags:
+      payload = element(names['ChapterUID'][0],
+          encode_uint(random_uid())) + payload
+    elif node.tag == 'Tag' and 'Targets' not in tags:
+      payload = element(TARGETS, b'') + payload
+  elif value_type == UINT:
+    payload = encode_uint(int(text))
+  elif value_type == TIME:
+    payload = encode_uint(parse_time(text))
+  elif value_type == BINARY:
+    payload = bytes(bytearray.fromhex(text))
+  else:
+    payload = (node.text or '').encode('utf-8')
+  return element(element_id, payload)
+
+def tags_from_xml(root):
+  """ The payload of a Tags element, from the root of a tags XML file. """
+  return b''.join(xml_element(child, TAG_ELEMENTS) for child in root
+      if isinstance(child.tag, str))
+
+def chapters_from_xml(root):
+  """ The payload of a Chapters element, from the root of a chapters XML
+  file. """
+  return b''.join(xml_element(child, CHAPTER_ELEMENTS) for child in root
+      if isinstance(child.tag, str))
+
+def is_global_tag(tag_payload):
+  """ Whether a Tag applies to the whole file, rather than to a track,
+  edition, chapter or attachment. """
+  for element_id, payload in child_elements(tag_payload):
+    if element_id == TARGETS:
+      for target_id, value in child_elements(payload):
+        if target_id in [TAG_TRACK_UID, TAG_EDITION_UID, TAG_CHAPTER_UID,
+            TAG_ATTACHMENT_UID] and decode_uint(value):
+          return False
+  return True
+
+#
+# Attachments
+#
+class AttachedFile(object):
+  def __init__(self, name, mime_type, data, description=None, uid=None,
+      raw=None):
+    self.name = name
+    self.mime_type = mime_type
+    self.data = data
+    self.description = description
+    self.uid = uid or random_uid()
+    self._raw = raw  # the original element, if read from a file
+
+  def encode(self):
+    if self._raw is not None:
+      return self._raw
+    payload = b''
+    if self.description:
+      payload += element(FILE_DESCRIPTION, self.description.encode('utf-8'))
+    payload += (element(FILE_NAME, self.name.encode('utf-8')) +
+        element(FILE_MIME_TYPE, self.mime_type.encode('utf-8')) +
+        element(FILE_DATA, self.data) +
+        element(FILE_UID, encode_uint(self.uid)))
+    return element(ATTACHED_FILE, payload)
+
+  @staticmethod
+  def decode(payload):
+    fields = {}
+    for element_id, value in child_elements(payload):
+      fields[element_id] = value
+    description = fields.get(FILE_DESCRIPTION)
+    return AttachedFile(fields.get(FILE_NAME, b'').decode('utf-8'),
+        fields.get(FILE_MIME_TYPE, b'').decode('utf-8'),
+        fields.get(FILE_DATA, b''),
+        description.decode('utf-8') if description is not None else None,
+        decode_uint(fields.get(FILE_UID, b'')),
+        element(ATTACHED_FILE, payload))
+
+  @staticmethod
+  def from_file(filename, name=None, mime_type=None, description=None):
+    if mime_type is None:
+      mime_type = (mimetypes.guess_type(filename)[0] or
+          'application/octet-stream')
+    with open(filename, 'rb') as handle:
+      data = handle.read()
+    return AttachedFile(name or os.path.basename(filename), mime_type, data,
+        description)
+
+#
+# The editor
+#
+class MatroskaFile(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self.handle = open(filename, 'r+b')
+    try:
+      self._parse()
+    except:
+      self.handle.close()
+      raise
+
+  def close(self):
+    self.handle.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _parse(self):
+    file_size = self._file_size()
+    header = read_element(self.handle, 0)
+    if header.id != EBML:
+      raise EditError('Not an EBML file: %s' % (self.filename))
+    self.segment = read_element(self.handle, header.end())
+    if self.segment.id != SEGMENT:
+      raise EditError('No segment found: %s' % (self.filename))
+    if self.segment.size == UNKNOWN_SIZE:
+      self.segment_end = file_size
+    else:
+      self.segment_end = self.segment.end()
+    if self.segment_end != file_size:
+      raise EditError('Data follows the segment: %s' % (self.filename))
+    self.size_width = (self.segment.data_offset - self.segment.offset -
+        len(encode_id(SEGMENT)))
+
+    # the level 1 elements before the first cluster, and those (anywhere)
+    # referenced by the SeekHead; only these are ever edited.
+    self.elements = []
+    offset = self.segment.data_offset
+    while offset < self.segment_end:
+      current = read_element(self.handle, offset)
+      if current.id == CLUSTER or current.size == UNKNOWN_SIZE:
+        break
+      self.elements.append(current)
+      offset = current.end()
+
+    seek_heads = [current for current in self.elements
+        if current.id == SEEK_HEAD]
+    if len(seek_heads) != 1:
+      raise EditError('Expected one SeekHead, found %d' % (len(seek_heads)))
+    self.seek_head = seek_heads[0]
+    self.seeks = []  # [id, position], position relative to the segment
+    for element_id, payload in child_elements(self._read(self.seek_head)):
+      if element_id != SEEK:
+        continue
+      fields = dict(child_elements(payload))
+      self.seeks.append([decode_uint(fields[SEEK_ID]),
+          decode_uint(fields[SEEK_POSITION])])
+
+    known = set(current.offset for current in self.elements)
+    for element_id, position in self.seeks:
+      offset = self.segment.data_offset + position
+      if offset in known or offset >= self.segment_end:
+        continue
+      current = read_element(self.handle, offset)
+      if current.id != element_id:
+        raise EditError('SeekHead entry mismatch at %d' % (offset))
+      self._add(current)
+      known.add(offset)
+      # padding that follows it can be reused too
+      following = current.end()
+      while following < self.segment_end and following not in known:
+        padding = read_element(self.handle, following)
+        if padding.id != VOID:
+          break
+        self._add(padding)
+        known.add(following)
+        following = padding.end()
+
+  def _add(self, current):
+    self.elements.append(current)
+    self.elements.sort(key=lambda current: current.offset)
+
+  def _read(self, current):
+    self.handle.seek(current.data_offset)
+    return self.handle.read(current.size)
+
+  def _write(self, offset, data):
+    self.handle.seek(offset)
+    self.handle.write(data)
+
+  def _space(self, current):
+    """ The elements from current through any Voids that directly follow
+    it. """
+    region = [current]
+    for candidate in self.elements:
+      if candidate.offset == region[-1].end() and candidate.id == VOID:
+        region.append(candidate)
+    return region
+
+  def _fill(self, offset, length, data):
+    """ Writes data at offset, padding the rest of length with a Void. """
+    self._write(offset, data)
+    for current in list(self.elements):
+      if offset <= current.offset < offset + length:
+        self.elements.remove(current)
+    if len(data) != 0:
+      self._add(read_element(self.handle, offset))
+    if len(data) < length:
+      self._write(offset + len(data), void(length - len(data)))
+      self._add(read_element(self.handle, offset + len(data)))
+
+  def _resize_segment(self, end):
+    if self.segment.size != UNKNOWN_SIZE:
+      self.segment.size += end - self.segment_end
+      self._write(self.segment.offset + len(encode_id(SEGMENT)),
+          encode_size(self.segment.size, self.size_width))
+    self.segment_end = end
+
+  def _append(self, data):
+    offset = self.segment_end
+    self._write(offset, data)
+    self._resize_segment(offset + len(data))
+    self._add(read_element(self.handle, offset))
+    return offset
+
+  def _truncate(self, offset):
+    for current in list(self.elements):
+      if current.offset >= offset:
+        self.elements.remove(current)
+    self.handle.truncate(offset)
+    self._resize_segment(offset)
+
+  def _place(self, data):
+    """ Writes data into the first Void with room for it, or at the end of
+    the segment, returning its offset.  The padding after the SeekHead is
+    left for it to grow into. """
+    reserved = self._space(self.seek_head)
+    for current in self.elements:
+      if current.id != VOID or current in reserved:
+        continue
+      end = self._space(current)[-1].end()
+      if end == self.segment_end:
+        # padding at the end of the file is reused at any size
+        self._truncate(current.offset)
+        break
+      if fits(len(data), end - current.offset):
+        self._fill(current.offset, end - current.offset, data)
+        return current.offset
+    return self._append(data)
+
+  def _file_size(self):
+    self.handle.seek(0, os.SEEK_END)
+    return self.handle.tell()
+
+  def _seek_head_data(self, seeks):
+    return element(SEEK_HEAD, b''.join(element(SEEK,
+        element(SEEK_ID, encode_id(element_id)) +
+        element(SEEK_POSITION, encode_uint(position)))
+        for element_id, position in seeks))
+
+  def _write_seek_head(self):
+    region = self._space(self.seek_head)
+    length = region[-1].end() - self.seek_head.offset
+    data = self._seek_head_data(self.seeks)
+    if not fits(len(data), length):
+      raise EditError('No room to grow the SeekHead')
+    self._fill(self.seek_head.offset, length, data)
+    self.seek_head = read_element(self.handle, self.seek_head.offset)
+
+  def element_data(self, element_id):
+    """ The payload of the first element with the id, or None. """
+    for current in self.elements:
+      if current.id == element_id:
+        return self._read(current)
+    return None
+
+  def replace(self, element_id, payload, relocate=True):
+    """ Replaces every element with the id by one with the payload, or
+    removes them if it is None.  Unless relocate is set, the new element has
+    to fit where the first one is (for elements expected before the
+    clusters, such as Tracks). """
+    existing = [current for current in self.elements
+        if current.id == element_id]
+    data = element(element_id, payload) if payload is not None else None
+    if not existing and data is None:
+      return
+
+    # make sure the SeekHead can be updated before changing anything
+    seeks = [seek for seek in self.seeks if seek[0] != element_id]
+    if data is not None:
+      seeks.append([element_id, (1 << 64) - 1])
+    region = self._space(self.seek_head)
+    if not fits(len(self._seek_head_data(seeks)),
+        region[-1].end() - self.seek_head.offset):
+      raise EditError('No room to grow the SeekHead')
+    if not relocate and data is not None:
+      if not existing:
+        raise EditError('No element to replace in place')
+      space = self._space(existing[0])[-1].end() - existing[0].offset
+      if not fits(len(data), space):
+        raise EditError('No room to grow the element in place')
+
+    for current in existing:
+      region = self._space(current)
+      self._fill(current.offset, region[-1].end() - current.offset, b'')
+
+    if data is not None:
+      if relocate:
+        offset = self._place(data)
+      else:
+        offset = existing[0].offset
+        self._fill(offset, space, data)
+      seeks[-1][1] = offset - self.segment.data_offset
+
+    self.seeks = seeks
+    self._write_seek_head()
+
+  def replace_global_tags(self, payload):
+    """ Replaces the tags that apply to the whole file, keeping those for
+    tracks, chapters, etc. """
+    kept = b''
+    existing = self.element_data(TAGS)
+    if existing is not None:
+      for element_id, tag in child_elements(existing):
+        if element_id == TAG and not is_global_tag(tag):
+          kept += element(TAG, tag)
+    payload = kept + (payload or b'')
+    self.replace(TAGS, payload or None)
+
+  def attached_files(self):
+    existing = self.element_data(ATTACHMENTS)
+    if existing is None:
+      return []
+    return [AttachedFile.decode(payload) for element_id, payload
+        in child_elements(existing) if element_id == ATTACHED_FILE]
+
+  def set_attached_files(self, attached_files):
+    payload = b''.join(attached.encode() for attached in attached_files)
+    self.replace(ATTACHMENTS, payload or None)
+
+  def set_audio_language(self, language):
+    """ Sets the language of the first audio track.  The Tracks element is
+    only ever rewritten in place. """
+    tracks = self.element_data(TRACKS)
+    if tracks is None:
+      raise EditError('No Tracks element')
+    # a CRC-32 wouldn't match anymore
+    entries = [entry for entry in child_elements(tracks) if entry[0] != CRC32]
+    for index, (element_id, payload) in enumerate(entries):
+      if element_id != TRACK_ENTRY:
+        continue
+      children = list(child_elements(payload))
+      if not [value for child_id, value in children
+          if child_id == TRACK_TYPE and decode_uint(value) == TRACK_TYPE_AUDIO]:
+        continue
+      # the BCP 47 form takes precedence if present, so drop it
+      children = [child for child in children
+          if child[0] not in [LANGUAGE, LANGUAGE_BCP47, CRC32]]
+      children.append((LANGUAGE, language.encode('ascii')))
+      entries[index] = (TRACK_ENTRY,
+          b''.join(element(child_id, value) for child_id, value in children))
+      break
+    else:
+      raise EditError('No audio track')
+    self.replace(TRACKS, b''.join(element(element_id, payload)
+        for element_id, payload in entries), relocate=False)